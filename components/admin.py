@@ -3,18 +3,7 @@
 
 # imports
 # components import
-from components.db import sql_query, dict_sql_query
-from components.core import calculate_available_spaces
-
-
-def get_activites_with_spaces():
-    query = sql_query("SELECT * FROM activities")
-
-    activities = []
-    for activity in query:
-        activities.append((activity, calculate_available_spaces(activity[0])))
-
-    return activities
+from components.db import dict_sql_query
 
 
 def get_activity_questions_and_options(id):
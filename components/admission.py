@@ -0,0 +1,157 @@
+# tullinge/booking
+# https://github.com/tullinge/booking
+
+# Admission control for the booking surge. Students get a ticket in their
+# session and wait in a queue in Redis until they are admitted. At most
+# ADMISSION_MAX_ACTIVE students are admitted at the same time and at most
+# ADMISSION_RATE are let in per second. Admitted students keep their slot for
+# as long as they make a request every ADMISSION_IDLE_SECONDS. If Redis is
+# unavailable everyone is admitted.
+
+# imports
+import secrets
+from os import environ
+from time import time
+
+from flask import session
+from redis.exceptions import RedisError
+
+# components import
+from components.redis_obj import redis_client
+
+# students admitted at the same time, 0 disables the queue
+ADMISSION_MAX_ACTIVE = int(environ.get("ADMISSION_MAX_ACTIVE", 0))
+
+# students let in per second
+ADMISSION_RATE = float(environ.get("ADMISSION_RATE", 20))
+
+# seconds an admitted student keeps the slot without making a request
+ADMISSION_IDLE_SECONDS = float(environ.get("ADMISSION_IDLE_SECONDS", 120))
+
+# seconds between refreshes of the queue page
+ADMISSION_REFRESH_SECONDS = int(environ.get("ADMISSION_REFRESH_SECONDS", 5))
+
+QUEUE_KEY = "booking:admission:queue"  # ticket -> place in line
+SEEN_KEY = "booking:admission:seen"  # queued ticket -> last refresh
+ADMITTED_KEY = "booking:admission:admitted"  # ticket -> admitted until
+SEQUENCE_KEY = "booking:admission:sequence"
+BUCKET_KEY = "booking:admission:bucket"  # token bucket for ADMISSION_RATE
+
+# queued tickets that have not refreshed for this long are dropped (tab closed)
+ABANDONED_AFTER_REFRESHES = 3
+
+# Runs atomically in Redis: drops expired and abandoned tickets, admits from
+# the head of the queue as far as rate and capacity allow, then returns
+# {1} for an admitted ticket or {0, position, queue length} for a queued one.
+ADMISSION_SCRIPT = redis_client.register_script("""
+local queue, seen, admitted, sequence, bucket = KEYS[1], KEYS[2], KEYS[3], KEYS[4], KEYS[5]
+local ticket = ARGV[1]
+local now = tonumber(ARGV[2])
+local max_active = tonumber(ARGV[3])
+local rate = tonumber(ARGV[4])
+local idle = tonumber(ARGV[5])
+local abandoned = tonumber(ARGV[6])
+
+redis.call("ZREMRANGEBYSCORE", admitted, "-inf", now)
+
+local stale = redis.call("ZRANGEBYSCORE", seen, "-inf", now - abandoned, "LIMIT", 0, 100)
+for _, stale_ticket in ipairs(stale) do
+    redis.call("ZREM", queue, stale_ticket)
+    redis.call("ZREM", seen, stale_ticket)
+end
+
+if redis.call("ZSCORE", admitted, ticket) then
+    redis.call("ZADD", admitted, now + idle, ticket)
+    return {1}
+end
+
+if not redis.call("ZSCORE", queue, ticket) then
+    redis.call("ZADD", queue, redis.call("INCR", sequence), ticket)
+end
+redis.call("ZADD", seen, now, ticket)
+
+-- refill the token bucket, holding at most one second worth of tokens (or one)
+local tokens = tonumber(redis.call("HGET", bucket, "tokens") or rate)
+local updated = tonumber(redis.call("HGET", bucket, "updated") or now)
+tokens = math.min(math.max(rate, 1), tokens + math.max(0, now - updated) * rate)
+
+local amount = math.min(
+    math.floor(tokens),
+    max_active - redis.call("ZCARD", admitted),
+    redis.call("ZCARD", queue)
+)
+
+if amount > 0 then
+    local popped = redis.call("ZPOPMIN", queue, amount)
+    for i = 1, #popped, 2 do
+        redis.call("ZADD", admitted, now + idle, popped[i])
+        redis.call("ZREM", seen, popped[i])
+    end
+    tokens = tokens - amount
+end
+
+redis.call("HSET", bucket, "tokens", tokens, "updated", now)
+
+if redis.call("ZSCORE", admitted, ticket) then
+    return {1}
+end
+
+return {0, redis.call("ZRANK", queue, ticket) + 1, redis.call("ZCARD", queue)}
+""")
+
+
+def admission_enabled():
+    return ADMISSION_MAX_ACTIVE > 0
+
+
+def check_admission():
+    """
+    Returns None if the student in session is admitted, otherwise
+    (position, queue length) of the student's place in the queue
+    """
+
+    if not admission_enabled():
+        return None
+
+    ticket = session.get("admission_ticket")
+    if not ticket:
+        ticket = session["admission_ticket"] = secrets.token_urlsafe(16)
+
+    try:
+        result = ADMISSION_SCRIPT(
+            keys=[QUEUE_KEY, SEEN_KEY, ADMITTED_KEY, SEQUENCE_KEY, BUCKET_KEY],
+            args=[
+                ticket,
+                time(),
+                ADMISSION_MAX_ACTIVE,
+                ADMISSION_RATE,
+                ADMISSION_IDLE_SECONDS,
+                ADMISSION_REFRESH_SECONDS * ABANDONED_AFTER_REFRESHES,
+            ],
+        )
+    except RedisError:
+        # fail open, the queue only protects the database
+        return None
+
+    if result[0] == 1:
+        return None
+
+    return result[1], result[2]
+
+
+def leave_admission():
+    """Gives up the student's slot (or place in the queue), e.g. on logout"""
+
+    ticket = session.pop("admission_ticket", None)
+
+    if not ticket or not admission_enabled():
+        return
+
+    try:
+        pipe = redis_client.pipeline()
+        pipe.zrem(ADMITTED_KEY, ticket)
+        pipe.zrem(QUEUE_KEY, ticket)
+        pipe.zrem(SEEN_KEY, ticket)
+        pipe.execute()
+    except RedisError:
+        pass
@@ -0,0 +1,374 @@
+# tullinge/booking
+# https://github.com/tullinge/booking
+
+# imports
+import json
+
+import pymysql
+
+# components import
+from components.db import sql_query, dict_sql_query, transaction
+from components.live_spaces import spaces_changed
+from components.metrics import inc
+
+# results of book_activity
+BOOKED = "booked"
+FULL = "full"
+NOT_FOUND = "not_found"
+
+# MySQL error codes that are safe to retry (lock wait timeout, deadlock)
+DEADLOCK_ERRORS = (1205, 1213)
+DEADLOCK_RETRIES = 3
+
+
+def _retry_on_deadlock(f, *args):
+    for attempt in range(DEADLOCK_RETRIES):
+        try:
+            return f(*args)
+        except pymysql.err.OperationalError as e:
+            if e.args[0] not in DEADLOCK_ERRORS or attempt == DEADLOCK_RETRIES - 1:
+                raise
+
+
+def answer_rows(answers):
+    """Turns (question, answer) tuples into (question id, option id, written answer) rows"""
+
+    # option ids are posted as strings, stored as ints so waitlisted answers
+    # still compare equal to the option ids read back from the database
+    return [
+        (
+            (question["id"], None, str(answer))
+            if question["written_answer"]
+            else (question["id"], int(answer) if answer else None, None)
+        )
+        for question, answer in answers
+    ]
+
+
+def book_activity(student_id, activity_id, answers):
+    """
+    Books student to activity and stores the answers in one transaction
+
+    The seat is taken with a conditional update of the activity's booked
+    counter, so two students can never both get the last seat. The seat of
+    the previously booked activity is released in the same transaction and
+    given to the first student on its waitlist. Re-booking the activity the
+    student already has only replaces the answers. A booking also removes the
+    student from any waitlist.
+
+    :param int student_id: Id of the student
+    :param int activity_id: Id of the activity to book
+    :param list answers: List of (question, answer) tuples, question being the question dict
+    Returns BOOKED, FULL or NOT_FOUND
+    """
+
+    return _retry_on_deadlock(
+        _book_activity, student_id, activity_id, answer_rows(answers)
+    )
+
+
+def _book_activity(student_id, activity_id, answer_rows):
+    with transaction() as cursor:
+        result, released_activity = _book(cursor, student_id, activity_id, answer_rows)
+
+        if released_activity:
+            _promote_waitlists(cursor, [released_activity])
+
+    if result == BOOKED:
+        spaces_changed()
+
+    inc("booking_bookings_total", result=result)
+
+    return result
+
+
+def _book(cursor, student_id, activity_id, answer_rows):
+    """
+    Books student to activity using cursor, does not commit
+
+    Returns (result, id of the activity whose seat was released or None)
+    """
+
+    cursor.execute(
+        "SELECT chosen_activity FROM students WHERE id = %s FOR UPDATE",
+        (student_id,),
+    )
+    student = cursor.fetchone()
+
+    if not student:
+        return NOT_FOUND, None
+
+    previous_activity = student["chosen_activity"]
+    released_activity = None
+
+    if previous_activity != activity_id:
+        # update counters in id order, concurrent re-bookings between the
+        # same two activities would otherwise deadlock
+        for counter_id in sorted(filter(None, {activity_id, previous_activity})):
+            if counter_id == activity_id:
+                cursor.execute(
+                    "UPDATE activities SET booked = booked + 1 WHERE id = %s AND booked < spaces",
+                    (activity_id,),
+                )
+
+                if cursor.rowcount == 0:
+                    # full or removed, take back any released seat
+                    if released_activity:
+                        cursor.execute(
+                            "UPDATE activities SET booked = booked + 1 WHERE id = %s",
+                            (released_activity,),
+                        )
+
+                    cursor.execute(
+                        "SELECT id FROM activities WHERE id = %s", (activity_id,)
+                    )
+                    if not cursor.fetchone():
+                        return NOT_FOUND, None
+
+                    return FULL, None
+            else:
+                cursor.execute(
+                    "UPDATE activities SET booked = booked - 1 WHERE id = %s AND booked > 0",
+                    (previous_activity,),
+                )
+                released_activity = previous_activity
+
+    # replace any previous answers this student has submitted
+    cursor.execute("DELETE FROM answers WHERE student_id = %s", (student_id,))
+
+    if answer_rows:
+        cursor.executemany(
+            "INSERT INTO answers (student_id, question_id, option_id, written_answer) VALUES (%s, %s, %s, %s)",
+            [(student_id, *row) for row in answer_rows],
+        )
+
+    cursor.execute(
+        "UPDATE students SET chosen_activity = %s, attendance = 0 WHERE id = %s",
+        (activity_id, student_id),
+    )
+
+    # booked, no longer waiting for this or any other activity
+    cursor.execute("DELETE FROM waitlist WHERE student_id = %s", (student_id,))
+
+    return BOOKED, released_activity
+
+
+def answer_ids(cursor, activity_ids):
+    """
+    Returns (question ids, option ids) by activity id, to check stored answer
+    rows against (see valid_answer_rows)
+    """
+
+    ids = {activity_id: (set(), set()) for activity_id in activity_ids}
+
+    if not ids:
+        return ids
+
+    cursor.execute(
+        f"""
+        SELECT questions.activity_id, questions.id AS question_id, options.id AS option_id
+        FROM questions
+        LEFT JOIN options ON options.question_id = questions.id
+        WHERE questions.activity_id IN ({", ".join(["%s"] * len(ids))})
+        """,
+        list(ids),
+    )
+
+    for row in cursor.fetchall():
+        question_ids, option_ids = ids[row["activity_id"]]
+        question_ids.add(row["question_id"])
+
+        # compared as strings, entries stored before option ids were converted
+        # to ints hold the posted string
+        option_ids.add(str(row["option_id"]))
+
+    return ids
+
+
+def valid_answer_rows(ids, answer_rows):
+    """
+    Returns the stored answer rows that still fit the activity
+
+    Questions and options may have been removed since the answers were given.
+
+    :param tuple ids: (question ids, option ids) of the activity, see answer_ids
+    """
+
+    question_ids, option_ids = ids
+
+    return [
+        (question_id, None if option_id is None else int(option_id), written_answer)
+        for question_id, option_id, written_answer in answer_rows
+        if question_id in question_ids
+        and (option_id is None or str(option_id) in option_ids)
+    ]
+
+
+def _promote_waitlists(cursor, activity_ids):
+    """
+    Gives free seats of activities to the students first on their waitlists
+
+    A promoted student releases the seat of their previous activity, which is
+    in turn given to the first student on that activity's waitlist.
+    """
+
+    pending = list(activity_ids)
+
+    while pending:
+        activity_id = pending.pop(0)
+
+        while True:
+            cursor.execute(
+                "SELECT id, student_id, answers FROM waitlist WHERE activity_id = %s ORDER BY id LIMIT 1 FOR UPDATE",
+                (activity_id,),
+            )
+            entry = cursor.fetchone()
+
+            if not entry:
+                break
+
+            result, released_activity = _book(
+                cursor,
+                entry["student_id"],
+                activity_id,
+                valid_answer_rows(
+                    answer_ids(cursor, [activity_id])[activity_id],
+                    json.loads(entry["answers"]),
+                ),
+            )
+
+            if result == FULL:
+                break
+
+            cursor.execute("DELETE FROM waitlist WHERE id = %s", (entry["id"],))
+
+            if released_activity:
+                pending.append(released_activity)
+
+
+def promote_waitlist(activity_id):
+    """Books students from the waitlist of activity while it has free seats"""
+
+    def _promote():
+        with transaction() as cursor:
+            _promote_waitlists(cursor, [activity_id])
+
+    _retry_on_deadlock(_promote)
+    spaces_changed()
+
+
+def join_waitlist(student_id, activity_id, answers):
+    """
+    Puts student on the waitlist of activity, replacing any other waitlist entry
+
+    Answers are stored with the entry and used when the student is promoted.
+    The student keeps the current booking until then.
+
+    :param list answers: List of (question, answer) tuples, see book_activity
+    Returns the student's position in the waitlist, None if a seat was free
+    and the student got booked right away
+    """
+
+    return _retry_on_deadlock(
+        _join_waitlist, student_id, activity_id, answer_rows(answers)
+    )
+
+
+def _join_waitlist(student_id, activity_id, answer_rows):
+    with transaction() as cursor:
+        cursor.execute("DELETE FROM waitlist WHERE student_id = %s", (student_id,))
+        cursor.execute(
+            "INSERT INTO waitlist (student_id, activity_id, answers) VALUES (%s, %s, %s)",
+            (student_id, activity_id, json.dumps(answer_rows)),
+        )
+
+        # a seat may have been freed since the booking attempt
+        _promote_waitlists(cursor, [activity_id])
+
+    spaces_changed()
+
+    entry = waitlist_position(student_id)
+
+    return entry[1] if entry else None
+
+
+def leave_waitlist(student_id):
+    """Removes student from any waitlist"""
+
+    sql_query("DELETE FROM waitlist WHERE student_id = %s", params=(student_id,))
+
+
+def waitlist_position(student_id):
+    """Returns (activity id, position) of the student's waitlist entry, None if not waiting"""
+
+    entry = dict_sql_query(
+        """
+        SELECT waitlist.activity_id, COUNT(*) AS position
+        FROM waitlist
+        INNER JOIN waitlist AS ahead
+            ON ahead.activity_id = waitlist.activity_id AND ahead.id <= waitlist.id
+        WHERE waitlist.student_id = %s
+        GROUP BY waitlist.activity_id
+        """,
+        params=(student_id,),
+        fetchone=True,
+    )
+
+    return (entry["activity_id"], entry["position"]) if entry else None
+
+
+def delete_student(student_id):
+    """Deletes student, the seat of the booked activity goes to its waitlist"""
+
+    def _delete():
+        with transaction() as cursor:
+            cursor.execute(
+                "SELECT chosen_activity FROM students WHERE id = %s FOR UPDATE",
+                (student_id,),
+            )
+            student = cursor.fetchone()
+
+            if not student:
+                return
+
+            cursor.execute("DELETE FROM students WHERE id = %s", (student_id,))
+
+            if student["chosen_activity"]:
+                cursor.execute(
+                    "UPDATE activities SET booked = booked - 1 WHERE id = %s AND booked > 0",
+                    (student["chosen_activity"],),
+                )
+                _promote_waitlists(cursor, [student["chosen_activity"]])
+
+    _retry_on_deadlock(_delete)
+    spaces_changed()
+
+
+def delete_activity(activity_id):
+    """
+    Deletes activity
+
+    Foreign keys delete its questions, options, answers and leaders, and
+    unbook its students.
+    """
+
+    sql_query("DELETE FROM activities WHERE id = %s", params=(activity_id,))
+    spaces_changed()
+
+
+def reconcile_booked():
+    """Rebuilds the booked counter of every activity from students"""
+
+    with transaction() as cursor:
+        cursor.execute("""
+            UPDATE activities
+            LEFT JOIN (
+                SELECT chosen_activity, COUNT(*) AS amount
+                FROM students
+                WHERE chosen_activity IS NOT NULL
+                GROUP BY chosen_activity
+            ) AS booked_students ON booked_students.chosen_activity = activities.id
+            SET activities.booked = COALESCE(booked_students.amount, 0)
+            """)
+
+        return cursor.rowcount
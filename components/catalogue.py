@@ -0,0 +1,182 @@
+# tullinge/booking
+# https://github.com/tullinge/booking
+
+# imports
+import json
+from os import environ
+from time import monotonic
+
+from redis.exceptions import RedisError
+
+# components import
+from components.db import dict_sql_query
+from components.redis_obj import redis_client
+
+# seconds a worker trusts its in-memory catalogue before checking the generation
+CATALOGUE_CACHE_SECONDS = float(environ.get("CATALOGUE_CACHE_SECONDS", 2))
+
+GENERATION_KEY = "booking:catalogue:generation"
+CATALOGUE_KEY = "booking:catalogue:{}"
+CATALOGUE_EXPIRE = 60 * 60 * 24
+
+# per-worker layer, replaced as a whole
+_local = {"generation": None, "catalogue": None, "checked_at": 0.0}
+
+# set when a generation bump could not be sent to Redis
+_pending = {"bump": False}
+
+
+def load_catalogue():
+    """
+    Loads activities with their questions and options from the database
+
+    Only contains data that changes when admins edit activities, live seat
+    counts are not part of the catalogue.
+    """
+
+    activities = dict_sql_query(
+        "SELECT id, name, spaces, info FROM activities ORDER BY id"
+    )
+    questions = dict_sql_query("SELECT * FROM questions ORDER BY id")
+    options = dict_sql_query("SELECT * FROM options ORDER BY id")
+
+    options_by_question = {}
+    for option in options:
+        options_by_question.setdefault(option["question_id"], []).append(option)
+
+    questions_by_activity = {}
+    for question in questions:
+        questions_by_activity.setdefault(question["activity_id"], []).append(
+            {"info": question, "options": options_by_question.get(question["id"], [])}
+        )
+
+    for activity in activities:
+        activity["questions"] = questions_by_activity.get(activity["id"], [])
+
+    return activities
+
+
+def _get_generation():
+    # retry a failed bump first, the cached generation is outdated until then
+    if _pending["bump"]:
+        try:
+            redis_client.incr(GENERATION_KEY)
+        except RedisError:
+            return None
+
+        _pending["bump"] = False
+
+    try:
+        return int(redis_client.get(GENERATION_KEY) or 0)
+    except RedisError:
+        return None
+
+
+def get_catalogue():
+    """
+    Returns the cached catalogue (see load_catalogue) as dict of activities by id
+
+    Workers keep the catalogue in memory and compare it against the generation
+    counter in Redis at most every CATALOGUE_CACHE_SECONDS. When the generation
+    has changed the catalogue of that generation is read from Redis, or loaded
+    from the database and shared through Redis if no worker has done so yet.
+    """
+
+    global _local
+
+    local = _local
+    now = monotonic()
+
+    if (
+        local["catalogue"] is not None
+        and now - local["checked_at"] < CATALOGUE_CACHE_SECONDS
+    ):
+        return local["catalogue"]
+
+    generation = _get_generation()
+
+    if (
+        local["catalogue"] is not None
+        and generation is not None
+        and generation == local["generation"]
+    ):
+        _local = dict(local, checked_at=now)
+        return local["catalogue"]
+
+    activities = None
+    if generation is not None:
+        try:
+            cached = redis_client.get(CATALOGUE_KEY.format(generation))
+            activities = json.loads(cached) if cached else None
+        except RedisError:
+            pass
+
+    if activities is None:
+        activities = load_catalogue()
+
+        if generation is not None:
+            try:
+                redis_client.set(
+                    CATALOGUE_KEY.format(generation),
+                    json.dumps(activities, default=str),
+                    ex=CATALOGUE_EXPIRE,
+                )
+            except RedisError:
+                pass
+
+    catalogue = {activity["id"]: activity for activity in activities}
+    _local = {"generation": generation, "catalogue": catalogue, "checked_at": now}
+
+    return catalogue
+
+
+def bump_catalogue_generation():
+    """
+    Invalidates the catalogue in all workers, call after activities,
+    questions or options have been changed
+    """
+
+    global _local
+
+    _local = {"generation": None, "catalogue": None, "checked_at": 0.0}
+
+    try:
+        redis_client.incr(GENERATION_KEY)
+    except RedisError:
+        # retried by this worker's next get_catalogue, which reads from the
+        # database meanwhile. Other workers keep the old catalogue until then
+        _pending["bump"] = True
+
+
+def get_catalogue_activity(activity_id):
+    """Returns activity dict (with questions) from the catalogue, or None"""
+
+    return get_catalogue().get(int(activity_id))
+
+
+def get_live_spaces():
+    """Returns dict of available spaces by activity id, read from the database"""
+
+    return {
+        row["id"]: row["available_spaces"]
+        for row in dict_sql_query(
+            "SELECT id, spaces - booked AS available_spaces FROM activities"
+        )
+    }
+
+
+def get_activity_catalogue():
+    """
+    Returns list of all activities along with their available spaces
+
+    Activities come from the cached catalogue, available spaces from a single
+    query regardless of the amount of activities.
+    """
+
+    spaces = get_live_spaces()
+
+    return [
+        {"activity": activity, "available_spaces": spaces[activity_id]}
+        for activity_id, activity in get_catalogue().items()
+        if activity_id in spaces
+    ]
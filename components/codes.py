@@ -2,17 +2,99 @@
 # https://github.com/tullinge/booking
 
 # imports
+import pymysql
+
 # components import
 from components.core import random_string
 from components.db import sql_query
 
+CODE_LENGTH = 8
+
+# attempts before giving up, collisions are rare with 36^8 possible codes
+CODE_RETRIES = 5
+
+# MySQL error code for duplicate entry on a UNIQUE key
+DUPLICATE_ENTRY = 1062
+
+
+def _taken_codes(codes, cursor=None):
+    """Returns the set of codes already used by a school class"""
+
+    placeholders = ", ".join(["%s"] * len(codes))
+    query = f"SELECT password FROM school_classes WHERE password IN ({placeholders})"
+
+    if cursor:
+        cursor.execute(query, list(codes))
+        return {row["password"] for row in cursor.fetchall()}
+
+    return {row[0] for row in sql_query(query, params=list(codes))}
+
+
+def generate_codes(amount, cursor=None):
+    """
+    Generates unique join codes for new school classes
+
+    Candidates are checked against the UNIQUE index on school_classes.password
+    with one query per attempt. Codes can still be taken by a concurrent insert,
+    use insert_school_classes to retry on that.
+
+    :param int amount: Amount of codes to generate
+    :param cursor: Cursor of an open transaction, if the classes are created inside one
+    Returns list of codes
+    """
+
+    codes = set()
+
+    for _ in range(CODE_RETRIES):
+        candidates = set()
+        while len(candidates) < amount - len(codes):
+            candidates.add(random_string(length=CODE_LENGTH))
+
+        codes |= candidates - codes - _taken_codes(candidates, cursor)
+
+        if len(codes) == amount:
+            return list(codes)
+
+    raise RuntimeError(f"Could not generate {amount} unique codes.")
+
+
+def generate_code(cursor=None):
+    """
+    Generates join code for a new school class
+
+    :param cursor: Cursor of an open transaction, if the class is created inside one
+    """
+
+    return generate_codes(1, cursor)[0]
+
+
+def insert_school_classes(cursor, class_names):
+    """
+    Creates school classes with newly generated join codes
+
+    Retries with new codes if a code was taken by a concurrent insert, any
+    other integrity error (e.g. class name already exists) is raised.
 
-def generate_code():
-    existing_passwords = sql_query("SELECT password FROM school_classes")
+    :param cursor: Cursor of an open transaction
+    :param list class_names: Names of the classes to create
+    """
 
-    password = random_string(length=8)
+    if not class_names:
+        return
 
-    if password not in str(existing_passwords):
-        return password
+    for attempt in range(CODE_RETRIES):
+        codes = generate_codes(len(class_names), cursor)
 
-    raise Exception("already exists!")
+        try:
+            cursor.executemany(
+                "INSERT INTO school_classes (class_name, password) VALUES (%s, %s)",
+                list(zip(class_names, codes)),
+            )
+            return
+        except pymysql.err.IntegrityError as e:
+            if (
+                e.args[0] != DUPLICATE_ENTRY
+                or "password" not in e.args[1]
+                or attempt == CODE_RETRIES - 1
+            ):
+                raise
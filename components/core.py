@@ -6,7 +6,7 @@ import string
 import hashlib
 import binascii
 import os
-import random
+import secrets
 
 from flask import request
 
@@ -34,14 +34,9 @@ def basic_validation(expected_values):
 def calculate_available_spaces(activity_id):
     """Returns integer of available spaces using specified activity_id"""
 
-    activity = sql_query(
-        "SELECT * FROM activities WHERE id = %s", params=(activity_id,)
-    )[0]
-    students = sql_query(
-        "SELECT * FROM students WHERE chosen_activity = %s", params=(activity_id,)
-    )
-
-    return activity[2] - len(students)
+    return sql_query(
+        "SELECT spaces - booked FROM activities WHERE id = %s", params=(activity_id,)
+    )[0][0]
 
 
 def hash_password(password):
@@ -71,10 +66,10 @@ def verify_password(stored_password, provided_password):
 
 
 def random_string(length=10):
-    """Generate a random string of fixed length"""
+    """Generate a random string of fixed length, using a cryptographic random source"""
 
     return "".join(
-        random.choice(string.ascii_uppercase + string.digits) for i in range(length)
+        secrets.choice(string.ascii_uppercase + string.digits) for i in range(length)
     )
 
 
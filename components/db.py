@@ -3,14 +3,155 @@
 
 # imports
 from os import environ
+from contextlib import contextmanager
+from time import monotonic, perf_counter
+from threading import Condition
+
 import pymysql
+from pymysql.constants import SERVER_STATUS
+from flask import g, has_app_context
+
+# components import
+from components.instrumentation import record_query, record_connect
+
+# pool settings
+POOL_SIZE = int(environ.get("MYSQL_POOL_SIZE", 10))
+POOL_TIMEOUT = float(environ.get("MYSQL_POOL_TIMEOUT", 10))
+POOL_MAX_IDLE = float(environ.get("MYSQL_POOL_MAX_IDLE", 300))
+POOL_PING_INTERVAL = float(environ.get("MYSQL_POOL_PING_INTERVAL", 30))
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection could be leased from the pool in time"""
+
+
+class ConnectionPool:
+    """
+    Bounded pool of MySQL connections
+
+    At most `size` connections are open at the same time. Connections that have
+    been idle for longer than `max_idle` seconds are replaced, and connections
+    idle for longer than `ping_interval` seconds are health checked before use.
+    """
+
+    def __init__(self, size, timeout, max_idle, ping_interval):
+        self.size = size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.ping_interval = ping_interval
+
+        self._idle = []  # (connection, released_at), most recently used last
+        self._open = 0
+        self._condition = Condition()
+        self.timeouts = 0  # acquires that gave up, for metrics
+
+    def acquire(self):
+        """Leases a connection, blocks for at most `timeout` seconds"""
+
+        deadline = monotonic() + self.timeout
+
+        with self._condition:
+            while True:
+                if self._idle:
+                    conn, released_at = self._idle.pop()
+                    break
+
+                if self._open < self.size:
+                    # reserve a slot, connection is created outside the lock
+                    self._open += 1
+                    conn, released_at = None, None
+                    break
+
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    self.timeouts += 1
+                    raise PoolTimeout(
+                        f"no database connection available within {self.timeout}s"
+                    )
+
+                self._condition.wait(remaining)
+
+        try:
+            if conn is None:
+                return create_conn()
+
+            idle = monotonic() - released_at
+
+            if idle > self.max_idle:
+                _close_quietly(conn)
+                return create_conn()
+
+            if idle > self.ping_interval:
+                try:
+                    conn.ping(reconnect=False)
+                except pymysql.err.Error:
+                    _close_quietly(conn)
+                    return create_conn()
+
+            return conn
+        except Exception:
+            # unable to connect, give back the reserved slot
+            with self._condition:
+                self._open -= 1
+                self._condition.notify()
+            raise
+
+    def release(self, conn, discard=False):
+        """Returns a leased connection, discarded connections are closed"""
+
+        if not discard:
+            try:
+                # never hand out a connection with a transaction still open
+                if conn.server_status & SERVER_STATUS.SERVER_STATUS_IN_TRANS:
+                    conn.rollback()
+            except pymysql.err.Error:
+                discard = True
+
+        if discard or not conn.open:
+            _close_quietly(conn)
+
+            with self._condition:
+                self._open -= 1
+                self._condition.notify()
+            return
+
+        with self._condition:
+            self._idle.append((conn, monotonic()))
+            self._condition.notify()
+
+
+def _close_quietly(conn):
+    try:
+        conn.close()
+    except pymysql.err.Error:
+        pass
+
+
+pool = ConnectionPool(
+    size=POOL_SIZE,
+    timeout=POOL_TIMEOUT,
+    max_idle=POOL_MAX_IDLE,
+    ping_interval=POOL_PING_INTERVAL,
+)
+
+
+class InstrumentedConnection(pymysql.connections.Connection):
+    """Connection that times every statement, see components/instrumentation.py"""
+
+    def query(self, sql, unbuffered=False):
+        started = perf_counter()
+
+        try:
+            return super().query(sql, unbuffered=unbuffered)
+        finally:
+            record_query(sql, perf_counter() - started)
 
 
 def create_conn():
     """
     Creates a connection from environment variables (or developer defaults if missing)
     """
-    return pymysql.connect(
+    return InstrumentedConnection(
         host=environ.get("MYSQL_HOST", "localhost"),
         user=environ.get("MYSQL_USER", "admin"),
         password=environ.get("MYSQL_PASSWORD", "do-not-use-in-production"),
@@ -18,26 +159,104 @@ def create_conn():
     )
 
 
-def sql_query(query, params: tuple = ()):
+def get_conn():
     """
-    Performs specified SQL query in database. Returns result from cursor.fetchall(), usually tuple
-    If searching for a specific object, note that object will be wrapped in outside tuple
+    Returns the connection leased for the current Flask request
+
+    The connection is leased on first use and returned to the pool when the
+    application context is torn down (see `release_conn`).
+    """
+
+    if "db_conn" not in g:
+        started = perf_counter()
+        g.db_conn = pool.acquire()
+        record_connect(perf_counter() - started)
+
+    return g.db_conn
+
+
+def release_conn(exception=None):
+    """Returns the connection of the current request to the pool"""
+
+    conn = g.pop("db_conn", None)
+
+    if conn is not None:
+        pool.release(conn)
+
+
+def init_db(app):
+    """Registers per-request connection handling on app"""
+
+    app.teardown_appcontext(release_conn)
+
+
+@contextmanager
+def _leased_conn():
     """
+    Yields the request connection when inside an application context,
+    otherwise a connection leased just for this block (scripts)
 
-    conn = create_conn()
+    Commits when the block succeeds and rolls back when it raises.
+    """
+
+    in_request = has_app_context()
+    conn = get_conn() if in_request else pool.acquire()
+    broken = False
 
     try:
-        with conn.cursor() as cursor:
+        yield conn
+        conn.commit()
+    except BaseException:
+        try:
+            conn.rollback()
+        except pymysql.err.Error:
+            broken = True
+        raise
+    finally:
+        # lost connections (closed by pymysql) are never reused
+        broken = broken or not conn.open
+
+        if not in_request:
+            pool.release(conn, discard=broken)
+        elif broken:
+            # next query in this request leases a fresh connection
+            g.pop("db_conn", None)
+            pool.release(conn, discard=True)
+
+
+@contextmanager
+def transaction():
+    """
+    Runs everything executed on the yielded DictCursor in one transaction
+
+    Commits when the block exits normally, rolls back if it raises. Do not call
+    sql_query/dict_sql_query inside the block, they commit on their own.
+    """
+
+    with _leased_conn() as conn:
+        conn.begin()
+
+        with conn.cursor(pymysql.cursors.DictCursor) as cursor:
+            yield cursor
+
+
+def _run(query, params, cursor_class, fetch):
+    with _leased_conn() as conn:
+        with conn.cursor(cursor_class) as cursor:
             if params != ():
                 cursor.execute(query, params)
             else:
                 cursor.execute(query)
-            result = cursor.fetchall()
-        conn.commit()
-    finally:
-        conn.close()
+            return fetch(cursor)
 
-    return result
+
+def sql_query(query, params: tuple = ()):
+    """
+    Performs specified SQL query in database. Returns result from cursor.fetchall(), usually tuple
+    If searching for a specific object, note that object will be wrapped in outside tuple
+    """
+
+    return _run(query, params, pymysql.cursors.Cursor, lambda c: c.fetchall())
 
 
 def dict_sql_query(query, fetchone=False, params: tuple = ()):
@@ -47,18 +266,41 @@ def dict_sql_query(query, fetchone=False, params: tuple = ()):
     Try to use this one as much as possible when querying for data.
     """
 
-    conn = create_conn()
+    return _run(
+        query,
+        params,
+        pymysql.cursors.DictCursor,
+        lambda c: c.fetchone() if fetchone else c.fetchall(),
+    )
+
+
+def stream_query(query, params: tuple = ()):
+    """
+    Yields the rows of query as dicts while they are read from the server
+
+    Uses an unbuffered cursor on a connection leased just for the stream (the
+    request connection stays usable), so the result set is never held in
+    memory. Works outside of the request too, e.g. in a streamed response.
+    If the consumer stops early the connection is closed instead of draining
+    the remaining rows.
+    """
+
+    started = perf_counter()
+    conn = pool.acquire()
+    record_connect(perf_counter() - started)
+    finished = False
 
     try:
-        with conn.cursor(pymysql.cursors.DictCursor) as cursor:
-            if params != ():
-                cursor.execute(query, params)
-            else:
-                cursor.execute(query)
-            result = cursor.fetchone() if fetchone else cursor.fetchall()
+        cursor = conn.cursor(pymysql.cursors.SSDictCursor)
 
-        conn.commit()
-    finally:
-        conn.close()
+        if params != ():
+            cursor.execute(query, params)
+        else:
+            cursor.execute(query)
+
+        yield from cursor
 
-    return result
+        cursor.close()
+        finished = True
+    finally:
+        pool.release(conn, discard=not finished)
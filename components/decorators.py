@@ -3,10 +3,13 @@
 
 # imports
 from functools import wraps
-from flask import session, redirect
+from flask import session, redirect, render_template
 
 # components import
-from components.db import sql_query, dict_sql_query
+from components.db import sql_query
+from components.student import get_student, forget_student
+from components.settings import booking_locked
+from components.admission import check_admission, ADMISSION_REFRESH_SECONDS
 
 
 def login_required(f):
@@ -17,13 +20,10 @@ def login_required(f):
             return redirect("/login")
 
         # check if student exists
-        student = sql_query(
-            "SELECT * FROM students WHERE id = %s", params=(session.get("id"),)
-        )
-
-        if not student:
+        if not get_student():
             session.pop("id", None)
             session.pop("logged_in", False)
+            forget_student()
 
             return redirect("/login")
 
@@ -78,11 +78,7 @@ def user_setup_completed(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
         # decorator should be after @login_required, therefore assume user auth
-        student = dict_sql_query(
-            "SELECT * FROM students WHERE id = %s",
-            fetchone=True,
-            params=(session.get("id"),),
-        )
+        student = get_student()
 
         if student:
             if not (
@@ -103,11 +99,7 @@ def user_not_setup(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
         # decorator should be after @login_required, therefore assume user auth
-        student = dict_sql_query(
-            "SELECT * FROM students WHERE id = %s",
-            fetchone=True,
-            params=(session.get("id"),),
-        )
+        student = get_student()
 
         if student:
             if student["class_id"]:
@@ -126,13 +118,7 @@ def booking_blocked(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
         # check setting
-        if (
-            dict_sql_query(
-                "SELECT value FROM settings WHERE identifier='booking_locked'",
-                fetchone=True,
-            )["value"]
-            == "1"
-        ):
+        if booking_locked():
             session.pop("id", None)
             session.pop("logged_in", False)
 
@@ -141,3 +127,31 @@ def booking_blocked(f):
         return f(*args, **kwargs)
 
     return decorated_function
+
+
+def admission_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        # nothing to queue for while booking is locked
+        if booking_locked():
+            return f(*args, **kwargs)
+
+        queued = check_admission()
+
+        if queued:
+            position, length = queued
+
+            return (
+                render_template(
+                    "student/queue.html",
+                    position=position,
+                    length=length,
+                    refresh=ADMISSION_REFRESH_SECONDS,
+                ),
+                200,
+                {"Cache-Control": "no-store"},
+            )
+
+        return f(*args, **kwargs)
+
+    return decorated_function
@@ -0,0 +1,258 @@
+# tullinge/booking
+# https://github.com/tullinge/booking
+
+# Streamed exports of students, bookings and answers. Rows are read from an
+# unbuffered cursor, pivoted and written to the response one student at a time,
+# so memory use does not grow with the amount of students.
+
+# imports
+import io
+import re
+import csv
+import zipfile
+from itertools import groupby
+from xml.sax.saxutils import escape
+
+# components import
+from components.db import stream_query
+from components.catalogue import get_catalogue
+
+# response is flushed to the client in chunks of roughly this many bytes
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+ATTENDANCE = {1: "Närvarande", 2: "Frånvarande"}
+
+STUDENT_COLUMNS = ["Förnamn", "Efternamn", "E-post", "Klass", "Aktivitet", "Närvaro"]
+
+# students with their answers, one row per answer (or one row without answers)
+EXPORT_QUERY = """
+    SELECT students.id, students.first_name, students.last_name, students.email,
+        school_classes.class_name, activities.name AS activity_name,
+        students.attendance, answers.question_id, answers.written_answer,
+        options.text AS option_text
+    FROM students
+    LEFT JOIN school_classes ON school_classes.id = students.class_id
+    LEFT JOIN activities ON activities.id = students.chosen_activity
+    LEFT JOIN answers ON answers.student_id = students.id
+    LEFT JOIN options ON options.id = answers.option_id
+    WHERE {}
+    ORDER BY students.id
+"""
+
+# what to export -> condition on students
+EXPORTS = {
+    "bookings": "students.chosen_activity IS NOT NULL",
+    "unbooked": "students.chosen_activity IS NULL",
+    "activity": "students.chosen_activity = %s",
+    "class": "students.class_id = %s",
+}
+
+
+def export_questions(activity_id=None):
+    """
+    Returns the questions that become answer columns, as (question id, header)
+
+    A single activity exports its own questions, otherwise the questions of all
+    activities are exported with the activity name in the header.
+    """
+
+    catalogue = get_catalogue()
+
+    if activity_id is not None:
+        activity = catalogue.get(int(activity_id))
+        return [
+            (question["info"]["id"], question["info"]["question"])
+            for question in (activity["questions"] if activity else [])
+        ]
+
+    return [
+        (question["info"]["id"], f"{activity['name']}: {question['info']['question']}")
+        for activity in catalogue.values()
+        for question in activity["questions"]
+    ]
+
+
+def pivot_students(rows, question_ids):
+    """
+    Turns rows of EXPORT_QUERY (ordered by student) into one row per student
+
+    Answers are placed in the column of their question, unanswered questions
+    are left empty. Consumes rows lazily, only one student is held at a time.
+    """
+
+    columns = {question_id: i for i, question_id in enumerate(question_ids)}
+
+    for _, student_rows in groupby(rows, key=lambda row: row["id"]):
+        answers = [""] * len(columns)
+
+        for row in student_rows:
+            if row["question_id"] in columns:
+                answers[columns[row["question_id"]]] = (
+                    row["option_text"]
+                    if row["written_answer"] is None
+                    else row["written_answer"]
+                ) or ""
+
+        yield [
+            row["first_name"] or "",
+            row["last_name"] or "",
+            row["email"],
+            row["class_name"] or "",
+            row["activity_name"] or "",
+            ATTENDANCE.get(row["attendance"], "Ej registrerad"),
+        ] + answers
+
+
+def export_rows(export, id=None):
+    """
+    Returns (header, rows) for export, rows being a lazy iterator
+
+    :param str export: One of EXPORTS
+    :param int id: Activity or class id, for the activity and class exports
+    """
+
+    if export == "unbooked":
+        questions = []
+    else:
+        questions = export_questions(id if export == "activity" else None)
+
+    rows = stream_query(
+        EXPORT_QUERY.format(EXPORTS[export]),
+        params=(id,) if id is not None else (),
+    )
+
+    header = STUDENT_COLUMNS + [header for _, header in questions]
+
+    return header, pivot_students(rows, [question_id for question_id, _ in questions])
+
+
+def _safe_cell(value):
+    """Prevents spreadsheet programs from evaluating student input as formulas"""
+
+    value = str(value)
+
+    if value[:1] in ("=", "+", "-", "@"):
+        return "'" + value
+
+    return value
+
+
+def csv_stream(header, rows):
+    """Yields CSV (utf-8 with BOM, for Excel) of header and rows in chunks"""
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    buffer.write("\ufeff")
+    writer.writerow(header)
+
+    for row in rows:
+        writer.writerow([_safe_cell(value) for value in row])
+
+        if buffer.tell() >= EXPORT_CHUNK_SIZE:
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+
+    yield buffer.getvalue().encode("utf-8")
+
+
+class _ChunkWriter:
+    """Write-only file object collecting the bytes zipfile writes"""
+
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        self.size = 0
+        return data
+
+
+XLSX_FILES = {
+    "[Content_Types].xml": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        "</Types>"
+    ),
+    "_rels/.rels": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+        "</Relationships>"
+    ),
+    "xl/workbook.xml": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="Elever" sheetId="1" r:id="rId1"/></sheets>'
+        "</workbook>"
+    ),
+    "xl/_rels/workbook.xml.rels": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+        "</Relationships>"
+    ),
+}
+
+
+# characters that are not allowed in XML documents
+XML_INVALID_CHARACTERS = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+
+def _xlsx_row(row):
+    cells = "".join(
+        '<c t="inlineStr"><is><t xml:space="preserve">'
+        f"{escape(XML_INVALID_CHARACTERS.sub('', str(value)))}</t></is></c>"
+        for value in row
+    )
+    return f"<row>{cells}</row>".encode("utf-8")
+
+
+def xlsx_stream(header, rows):
+    """
+    Yields an XLSX workbook of header and rows in chunks
+
+    The sheet uses inline strings, so it can be written top to bottom without
+    keeping a shared string table, and the zip is written to a non-seekable
+    stream (sizes end up in data descriptors).
+    """
+
+    output = _ChunkWriter()
+
+    with zipfile.ZipFile(output, "w", compression=zipfile.ZIP_DEFLATED) as workbook:
+        for name, content in XLSX_FILES.items():
+            workbook.writestr(name, content)
+
+        with workbook.open("xl/worksheets/sheet1.xml", "w", force_zip64=True) as sheet:
+            sheet.write(
+                b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+                b"<sheetData>"
+            )
+            sheet.write(_xlsx_row(header))
+
+            for row in rows:
+                sheet.write(_xlsx_row(row))
+
+                if output.size >= EXPORT_CHUNK_SIZE:
+                    yield output.take()
+
+            sheet.write(b"</sheetData></worksheet>")
+
+    yield output.take()
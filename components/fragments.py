@@ -0,0 +1,99 @@
+# tullinge/booking
+# https://github.com/tullinge/booking
+
+# Fragment cache for the student index. The activity list (names, info texts)
+# only changes with the catalogue, so it is rendered and minified once per
+# catalogue in each worker. Live seat counts are spliced into the cached
+# fragment on every request, and only the small per-student rest of the page is
+# rendered and minified per request (flask_minify bypasses the index).
+
+# imports
+import re
+import secrets
+from threading import Lock
+
+from flask import render_template
+from flask_minify.parsers import Parser
+
+# components import
+from components.catalogue import get_catalogue, get_live_spaces
+
+# markers are random per worker so that no name or info text can contain them
+_TOKEN = secrets.token_hex(8)
+
+# stands in for the activity list when rendering the page around it
+ACTIVITY_LIST_MARKER = f"%%ACTIVITY_LIST:{_TOKEN}%%"
+
+# stands in for the seat count of an activity in the cached fragment
+SPACES_MARKER = f"%%SPACES:{_TOKEN}:{{}}%%"
+SPACES_PATTERN = re.compile(f"%%SPACES:{_TOKEN}:(\\d+)%%")
+
+# same options flask_minify uses for responses
+_parser = Parser({}, True)
+_parser.update_runtime_options(True, True, True, [])
+
+_fragment = {"catalogue": None, "parts": None}
+_fragment_lock = Lock()
+
+
+def minify_html(html):
+    """Minifies html like flask_minify does for responses"""
+
+    return _parser.minify(html, "html")
+
+
+def _activity_list_parts():
+    """
+    Returns the minified activity list split around its seat counts
+
+    List of html parts alternating with activity ids, rendered again only when
+    the catalogue has changed.
+    """
+
+    catalogue = get_catalogue()
+    fragment = _fragment
+
+    # the catalogue object is replaced whenever its generation changes
+    if fragment["catalogue"] is catalogue:
+        return fragment["parts"]
+
+    with _fragment_lock:
+        if _fragment["catalogue"] is not catalogue:
+            html = minify_html(
+                render_template(
+                    "student/activity_list.html",
+                    activities=list(catalogue.values()),
+                    spaces_marker=SPACES_MARKER,
+                )
+            )
+
+            parts = SPACES_PATTERN.split(html)
+            for i in range(1, len(parts), 2):
+                parts[i] = int(parts[i])
+
+            _fragment.update(catalogue=catalogue, parts=parts)
+
+        return _fragment["parts"]
+
+
+def activity_list_html():
+    """Returns the minified activity list with live seat counts"""
+
+    parts = _activity_list_parts()
+    spaces = get_live_spaces()
+
+    return "".join(
+        str(spaces.get(part, 0)) if i % 2 else part for i, part in enumerate(parts)
+    )
+
+
+def render_student_index(**context):
+    """Renders student/index.html (minified) around the cached activity list"""
+
+    html = minify_html(
+        render_template(
+            "student/index.html", activity_list=ACTIVITY_LIST_MARKER, **context
+        )
+    )
+
+    return html.replace(ACTIVITY_LIST_MARKER, activity_list_html(), 1)
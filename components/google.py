@@ -5,13 +5,20 @@
 from flask import jsonify, abort, request
 from json import dumps
 
-from google.oauth2 import id_token
-from google.auth.transport import requests
+from google.auth import jwt
+from google.auth.exceptions import GoogleAuthError
 from oauthlib.oauth2 import WebApplicationClient
 
 import requests as requests_module
+from requests.adapters import HTTPAdapter
 
 from os import environ
+from time import monotonic
+import re
+from urllib.parse import urlsplit
+
+# components import
+from components.metrics import observe
 
 GOOGLE_CLIENT_ID = environ.get("GOOGLE_CLIENT_ID", default=False)
 GOOGLE_CLIENT_SECRET = environ.get("GOOGLE_CLIENT_SECRET", default=False)
@@ -19,13 +26,136 @@ APP_URL = environ.get("APP_URL", default="http://localhost:5000")
 GSUITE_DOMAIN_NAME = environ.get("GSUITE_DOMAIN_NAME", default=False)
 MENTOR_GSUITE_DOMAIN_NAME = environ.get("MENTOR_GSUITE_DOMAIN_NAME", default=False)
 GOOGLE_DISCOVERY_URL = "https://accounts.google.com/.well-known/openid-configuration"
+GOOGLE_CERTS_URL = "https://www.googleapis.com/oauth2/v1/certs"
+GOOGLE_ISSUERS = ["accounts.google.com", "https://accounts.google.com"]
+GOOGLE_VERIFY_ID_TOKEN = environ.get("GOOGLE_VERIFY_ID_TOKEN", "1") == "1"
+GOOGLE_HTTP_TIMEOUT = float(environ.get("GOOGLE_HTTP_TIMEOUT", 5))
+GOOGLE_HTTP_POOL_SIZE = int(environ.get("GOOGLE_HTTP_POOL_SIZE", 10))
+
+# claims google_login reads, userinfo is asked if the ID token lacks any of them
+REQUIRED_CLAIMS = ["email", "email_verified", "given_name", "family_name", "picture"]
+
+# used when a response has no Cache-Control max-age
+DEFAULT_CACHE_SECONDS = 3600
+
+
+def oauth_client():
+    """
+    Returns a new oauth2 client
+
+    The client keeps the tokens it parses, so every login needs its own: a
+    shared client would let concurrent logins (threads, greenlets) read each
+    other's access token.
+    """
+
+    return WebApplicationClient(GOOGLE_CLIENT_ID)
+
+
+# shared HTTP session, keeps TLS connections to Google open between requests
+http = requests_module.Session()
+http.mount(
+    "https://",
+    HTTPAdapter(pool_connections=4, pool_maxsize=GOOGLE_HTTP_POOL_SIZE),
+)
+
+
+def _observe_latency(response, *args, **kwargs):
+    # time until Google's response headers arrived, by endpoint
+    url = urlsplit(response.url)
+
+    observe(
+        "booking_oauth_request_duration_seconds",
+        response.elapsed.total_seconds(),
+        endpoint=f"{url.netloc}{url.path}",
+    )
+
+
+http.hooks["response"].append(_observe_latency)
+
+if environ.get("GOOGLE_OAUTH_STUB") == "1":
+    # offline test double, refused unless APP_URL is local
+    from components.google_stub import install_stub
+
+    install_stub(http, APP_URL)
+
+_json_cache = {}  # url -> (document, expires_at)
+
 
-# oauth2 client setup
-client = WebApplicationClient(GOOGLE_CLIENT_ID)
+def cache_seconds(response):
+    """Returns how many seconds response may be cached according to its headers"""
+
+    cache_control = response.headers.get("Cache-Control", "").lower()
+
+    if "no-store" in cache_control or "no-cache" in cache_control:
+        return 0
+
+    max_age = re.search(r"max-age=(\d+)", cache_control)
+    if not max_age:
+        return DEFAULT_CACHE_SECONDS
+
+    return max(int(max_age.group(1)) - int(response.headers.get("Age", 0)), 0)
+
+
+def get_cached_json(url):
+    """
+    GETs JSON document, cached for as long as its Cache-Control header allows
+
+    If Google can't be reached an expired document is used rather than failing.
+    """
+
+    cached = _json_cache.get(url)
+    if cached and monotonic() < cached[1]:
+        return cached[0]
+
+    try:
+        response = http.get(url, timeout=GOOGLE_HTTP_TIMEOUT)
+        response.raise_for_status()
+        document = response.json()
+    except (requests_module.RequestException, ValueError):
+        if cached:
+            return cached[0]
+        raise
+
+    _json_cache[url] = (document, monotonic() + cache_seconds(response))
+
+    return document
 
 
 def get_google_provider_cfg():
-    return requests_module.get(GOOGLE_DISCOVERY_URL).json()
+    return get_cached_json(GOOGLE_DISCOVERY_URL)
+
+
+def verify_id_token(token: str):
+    """
+    Verifies Google ID token locally using Google's cached certificates
+
+    Returns dict of the token's claims, or None if the token could not be
+    verified (the caller should then ask the userinfo endpoint instead).
+    """
+
+    # the audience can't be checked without a client id
+    if not GOOGLE_CLIENT_ID:
+        return None
+
+    for attempt in range(2):
+        try:
+            claims = jwt.decode(
+                token,
+                certs=get_cached_json(GOOGLE_CERTS_URL),
+                audience=GOOGLE_CLIENT_ID,
+                clock_skew_in_seconds=10,
+            )
+            break
+        except (ValueError, GoogleAuthError, requests_module.RequestException):
+            # keys may have been rotated since they were cached, refetch once
+            _json_cache.pop(GOOGLE_CERTS_URL, None)
+    else:
+        return None
+
+    if claims.get("iss") not in GOOGLE_ISSUERS:
+        return None
+
+    return claims
 
 
 def get_google_redirect_url(callback_url: str):
@@ -36,7 +166,7 @@ def get_google_redirect_url(callback_url: str):
     # Use library to construct the request for Google login and provide
     # scopes that let you retrieve user's profile from Google
 
-    request_uri = client.prepare_request_uri(
+    request_uri = oauth_client().prepare_request_uri(
         authorization_endpoint,
         redirect_uri=APP_URL + callback_url,
         scope=["openid", "email", "profile"],
@@ -56,44 +186,57 @@ def google_login(code: str, callback_url: str, ignore_wrong_hd=False):
     token_endpoint = google_provider_cfg["token_endpoint"]
 
     # Prepare and send a request to get tokens
+    client = oauth_client()
     token_url, headers, body = client.prepare_token_request(
         token_endpoint,
         authorization_response=request.url,
         redirect_url=APP_URL + callback_url,
         code=code,
     )
-    token_response = requests_module.post(
+    token_response = http.post(
         token_url,
         headers=headers,
         data=body,
         auth=(GOOGLE_CLIENT_ID, GOOGLE_CLIENT_SECRET),
+        timeout=GOOGLE_HTTP_TIMEOUT,
     )
 
     # Parse the tokens
-    client.parse_request_body_response(dumps(token_response.json()))
-
-    # Now that you have tokens let's find and hit the URL
-    # from Google that gives you the user's profile information,
-    # including their Google profile image and email
-    userinfo_endpoint = google_provider_cfg["userinfo_endpoint"]
-    uri, headers, body = client.add_token(userinfo_endpoint)
-    userinfo_response = requests_module.get(uri, headers=headers, data=body)
+    tokens = token_response.json()
+    client.parse_request_body_response(dumps(tokens))
+
+    # Read the user's profile from the ID token when it can be verified
+    # locally, which saves a round trip to Google
+    userinfo = None
+    if GOOGLE_VERIFY_ID_TOKEN and tokens.get("id_token"):
+        userinfo = verify_id_token(tokens["id_token"])
+
+    required_claims = REQUIRED_CLAIMS + ([] if ignore_wrong_hd else ["hd"])
+    if not userinfo or any(claim not in userinfo for claim in required_claims):
+        # Now that you have tokens let's find and hit the URL
+        # from Google that gives you the user's profile information,
+        # including their Google profile image and email
+        userinfo_endpoint = google_provider_cfg["userinfo_endpoint"]
+        uri, headers, body = client.add_token(userinfo_endpoint)
+        userinfo = http.get(
+            uri, headers=headers, data=body, timeout=GOOGLE_HTTP_TIMEOUT
+        ).json()
 
     # You want to make sure their email is verified.
     # The user authenticated with Google, authorized your
     # app, and now you've verified their email through Google!
-    if userinfo_response.json().get("email_verified"):
+    if userinfo.get("email_verified"):
         if not ignore_wrong_hd:
-            if "hd" not in userinfo_response.json():
+            if "hd" not in userinfo:
                 abort(400, "Email is not hosted domain. Please use your school email.")
 
         if not ignore_wrong_hd:
-            if userinfo_response.json()["hd"] != GSUITE_DOMAIN_NAME:
+            if userinfo["hd"] != GSUITE_DOMAIN_NAME:
                 abort(
                     400,
-                    f"This system requires that you login with your {GSUITE_DOMAIN_NAME}, but you logged in with {userinfo_response.json()['hd']}.",
+                    f"This system requires that you login with your {GSUITE_DOMAIN_NAME}, but you logged in with {userinfo['hd']}.",
                 )
 
-        return userinfo_response.json()
+        return userinfo
 
     abort(400, "User email not available or not verified by Google")
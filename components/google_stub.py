@@ -0,0 +1,241 @@
+# tullinge/booking
+# https://github.com/tullinge/booking
+
+# Test double for Google's OpenID Connect endpoints, so logins can be exercised
+# offline (development, benchmarks). Enabled with GOOGLE_OAUTH_STUB=1, which
+# lets anyone log in as any email address: never enable it in production.
+#
+# The authorization code is the email address to log in as, e.g. requesting
+# /callback?code=anna.svensson@example.com logs in that student. Names are
+# derived from the part before @ and `hd` from the domain. ID tokens are signed
+# with a key generated at startup, served on Google's certificate endpoint.
+
+# imports
+import json
+import base64
+import logging
+import datetime
+from os import environ
+from time import time, sleep
+from urllib.parse import urlparse, urlsplit, parse_qs
+
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from google.auth import crypt, jwt
+from requests import Response
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+
+# milliseconds the token and userinfo endpoints take to answer, like Google would
+GOOGLE_STUB_LATENCY_MS = float(environ.get("GOOGLE_STUB_LATENCY_MS", 0))
+
+# the app must be served from one of these for the stub to be installed
+LOCAL_HOSTS = ["localhost", "127.0.0.1", "::1"]
+
+logger = logging.getLogger("booking.google_stub")
+
+STUB_HOSTS = [
+    "https://accounts.google.com",
+    "https://oauth2.googleapis.com",
+    "https://openidconnect.googleapis.com",
+    "https://www.googleapis.com",
+]
+
+DISCOVERY_DOCUMENT = {
+    "issuer": "https://accounts.google.com",
+    "authorization_endpoint": "https://accounts.google.com/o/oauth2/v2/auth",
+    "token_endpoint": "https://oauth2.googleapis.com/token",
+    "userinfo_endpoint": "https://openidconnect.googleapis.com/v1/userinfo",
+    "jwks_uri": "https://www.googleapis.com/oauth2/v3/certs",
+}
+
+
+def _encode(email):
+    return base64.urlsafe_b64encode(email.encode("utf-8")).decode("ascii")
+
+
+def _decode(token):
+    return base64.urlsafe_b64decode(token.encode("ascii")).decode("utf-8")
+
+
+def stub_userinfo(email):
+    """Returns the userinfo claims the stub reports for email"""
+
+    local_part, domain = email.split("@", 1)
+    names = local_part.replace("_", ".").split(".")
+
+    return {
+        "sub": _encode(email),
+        "email": email,
+        "email_verified": True,
+        "hd": domain,
+        "given_name": names[0].capitalize(),
+        "family_name": names[-1].capitalize() if len(names) > 1 else "Stub",
+        "picture": "",
+    }
+
+
+def _generate_signing_key():
+    """Returns (private key PEM, self-signed certificate PEM) for signing ID tokens"""
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "google-stub")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(days=1))
+        .not_valid_after(now + datetime.timedelta(days=365))
+        .sign(key, hashes.SHA256())
+    )
+
+    private_pem = key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    )
+
+    return private_pem, certificate.public_bytes(serialization.Encoding.PEM)
+
+
+class GoogleStubAdapter(BaseAdapter):
+    """requests transport adapter answering Google's endpoints locally"""
+
+    KEY_ID = "google-stub"
+
+    def __init__(self):
+        super().__init__()
+
+        # amount of requests per path, lets callers verify caching
+        self.calls = {}
+
+        private_pem, self.certificate = _generate_signing_key()
+        self.signer = crypt.RSASigner.from_string(private_pem, key_id=self.KEY_ID)
+
+    def id_token(self, email, client_id):
+        """Returns an ID token for email signed like Google would"""
+
+        now = int(time())
+
+        return jwt.encode(
+            self.signer,
+            {
+                "iss": "https://accounts.google.com",
+                "aud": client_id,
+                "azp": client_id,
+                "iat": now,
+                "exp": now + 3600,
+                **stub_userinfo(email),
+            },
+        ).decode("ascii")
+
+    def send(self, request, **kwargs):
+        url = urlparse(request.url)
+        self.calls[url.path] = self.calls.get(url.path, 0) + 1
+
+        if url.path == "/.well-known/openid-configuration":
+            return self._response(
+                request, DISCOVERY_DOCUMENT, {"Cache-Control": "public, max-age=3600"}
+            )
+
+        if url.path == "/oauth2/v1/certs":
+            return self._response(
+                request,
+                {self.KEY_ID: self.certificate.decode("ascii")},
+                {"Cache-Control": "public, max-age=3600"},
+            )
+
+        if url.path in ["/token", "/v1/userinfo"] and GOOGLE_STUB_LATENCY_MS:
+            # cooperative under gevent, which patches sleep
+            sleep(GOOGLE_STUB_LATENCY_MS / 1000)
+
+        if url.path == "/token" and request.method == "POST":
+            body = request.body or ""
+            if isinstance(body, bytes):
+                body = body.decode("utf-8")
+
+            code = parse_qs(body).get("code", [""])[0]
+
+            if "@" not in code:
+                return self._response(request, {"error": "invalid_grant"}, status=400)
+
+            # client id is sent using HTTP basic auth
+            authorization = request.headers.get("Authorization", "")
+            client_id = (
+                base64.b64decode(authorization.replace("Basic ", ""))
+                .decode("utf-8")
+                .split(":")[0]
+            )
+
+            return self._response(
+                request,
+                {
+                    "access_token": _encode(code),
+                    "id_token": self.id_token(code, client_id),
+                    "token_type": "Bearer",
+                    "expires_in": 3599,
+                    "scope": "openid email profile",
+                },
+            )
+
+        if url.path == "/v1/userinfo":
+            token = request.headers.get("Authorization", "").replace("Bearer ", "")
+
+            try:
+                email = _decode(token)
+            except ValueError:
+                return self._response(request, {"error": "invalid_token"}, status=401)
+
+            return self._response(request, stub_userinfo(email))
+
+        return self._response(request, {"error": "not_found"}, status=404)
+
+    def _response(self, request, document, headers=None, status=200):
+        response = Response()
+        response.status_code = status
+        response.headers = CaseInsensitiveDict(
+            {"Content-Type": "application/json", **(headers or {})}
+        )
+        response._content = json.dumps(document).encode("utf-8")
+        response.encoding = "utf-8"
+        response.url = request.url
+        response.request = request
+
+        return response
+
+    def close(self):
+        pass
+
+
+def install_stub(session, app_url):
+    """
+    Routes all Google requests made through session to a GoogleStubAdapter
+
+    Refuses (RuntimeError) unless app_url is served from this machine, so a
+    GOOGLE_OAUTH_STUB leaking into a deployment stops the app from starting
+    instead of letting anyone log in as any user.
+    """
+
+    if urlsplit(app_url).hostname not in LOCAL_HOSTS:
+        raise RuntimeError(
+            f"GOOGLE_OAUTH_STUB is set but APP_URL {app_url} is not local, "
+            "refusing to replace Google login with the test double"
+        )
+
+    logger.warning(
+        "GOOGLE_OAUTH_STUB is enabled: anyone can log in as any user, admins "
+        "included, with /callback?code=<email>. Never enable it in production."
+    )
+
+    adapter = GoogleStubAdapter()
+
+    for host in STUB_HOSTS:
+        session.mount(host, adapter)
+
+    return adapter
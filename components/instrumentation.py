@@ -0,0 +1,191 @@
+# tullinge/booking
+# https://github.com/tullinge/booking
+
+# SQL instrumentation. Every statement sent to MySQL (see InstrumentedConnection
+# in components/db.py) is timed and recorded on the current Flask request:
+# amount of queries, total database time, time spent leasing connections and
+# the slowest statement. The numbers are sent as a Server-Timing header and
+# written as one JSON log line per request. Statements are normalized (values
+# replaced by ?) so the same statement with different values is recognized.
+
+# imports
+import re
+import json
+import logging
+from os import environ
+from time import perf_counter
+from collections import Counter
+
+from flask import g, request, has_app_context, has_request_context
+
+# send Server-Timing headers with the database numbers of the request
+SQL_SERVER_TIMING = environ.get("SQL_SERVER_TIMING", "1") == "1"
+
+# write one log line with the database numbers of every request
+SQL_REQUEST_LOG = environ.get("SQL_REQUEST_LOG", "1") == "1"
+
+# statements slower than this many milliseconds are logged, 0 disables
+SQL_SLOW_QUERY_MS = float(environ.get("SQL_SLOW_QUERY_MS", 500))
+
+# warn when the same statement runs more than this many times in one request, 0 disables
+SQL_N_PLUS_ONE_THRESHOLD = int(environ.get("SQL_N_PLUS_ONE_THRESHOLD", 0))
+
+logger = logging.getLogger("booking.sql")
+
+if not logger.handlers:
+    # gunicorn does not configure logging for the app, write to stderr
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter("%(levelname)s %(name)s %(message)s"))
+    logger.addHandler(_handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+_STRING = re.compile(r"'(?:[^'\\]|\\.|'')*'")
+_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_NULL = re.compile(r"(?<=[(,=])\s*NULL\b", re.IGNORECASE)
+_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_IN_ONE = re.compile(r"(\bIN\s*)\(\s*\?\s*\)", re.IGNORECASE)
+_ROWS = re.compile(r"\(\?\+\)(?:\s*,\s*\(\?\+\))+")
+_SPACE = re.compile(r"\s+")
+
+
+def normalize_sql(sql):
+    """
+    Returns sql with values replaced by ?, lists of values by (?+) and lists
+    of rows by (?+)+, so statements only differing in values are equal
+    """
+
+    if isinstance(sql, bytes):
+        sql = sql.decode("utf-8", "replace")
+
+    sql = _STRING.sub("?", sql)
+    sql = _NUMBER.sub("?", sql)
+    sql = _NULL.sub("?", sql)
+    sql = _LIST.sub("(?+)", sql)
+    sql = _IN_ONE.sub(r"\1(?+)", sql)
+    sql = _ROWS.sub("(?+)+", sql)
+
+    return _SPACE.sub(" ", sql).strip()
+
+
+class RequestStats:
+    """Database numbers of one request"""
+
+    def __init__(self):
+        self.started = perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.connect_time = 0.0
+        self.slowest = (0.0, None)  # (seconds, normalized statement)
+        self.statements = Counter()  # normalized statement -> times run
+
+
+def _request_stats():
+    if not has_app_context():
+        return None
+
+    return g.get("sql_stats")
+
+
+def record_query(sql, seconds):
+    """Records a statement that took seconds to run"""
+
+    stats = _request_stats()
+    slow = SQL_SLOW_QUERY_MS and seconds * 1000 >= SQL_SLOW_QUERY_MS
+
+    if stats is None and not slow:
+        return
+
+    normalized = normalize_sql(sql)
+
+    if slow:
+        logger.warning(
+            json.dumps(
+                {
+                    "event": "slow_query",
+                    "path": request.path if has_request_context() else None,
+                    "ms": round(seconds * 1000, 1),
+                    "sql": normalized,
+                }
+            )
+        )
+
+    if stats is None:
+        return
+
+    stats.queries += 1
+    stats.db_time += seconds
+    stats.statements[normalized] += 1
+
+    if seconds > stats.slowest[0]:
+        stats.slowest = (seconds, normalized)
+
+
+def record_connect(seconds):
+    """Records time spent leasing (and possibly opening) a connection"""
+
+    stats = _request_stats()
+
+    if stats is not None:
+        stats.connect_time += seconds
+
+
+def _start_request():
+    g.sql_stats = RequestStats()
+
+
+def _finish_request(response):
+    stats = g.pop("sql_stats", None)
+
+    if stats is None:
+        return response
+
+    if SQL_SERVER_TIMING:
+        response.headers.add(
+            "Server-Timing",
+            f'db;dur={stats.db_time * 1000:.1f};desc="{stats.queries} queries", '
+            f"db-connect;dur={stats.connect_time * 1000:.1f}",
+        )
+
+    if SQL_REQUEST_LOG:
+        logger.info(
+            json.dumps(
+                {
+                    "event": "request",
+                    "method": request.method,
+                    "path": request.path,
+                    "endpoint": request.endpoint,
+                    "status": response.status_code,
+                    "ms": round((perf_counter() - stats.started) * 1000, 1),
+                    "queries": stats.queries,
+                    "db_ms": round(stats.db_time * 1000, 1),
+                    "connect_ms": round(stats.connect_time * 1000, 1),
+                    "slowest_ms": round(stats.slowest[0] * 1000, 1),
+                    "slowest_sql": stats.slowest[1],
+                }
+            )
+        )
+
+    if SQL_N_PLUS_ONE_THRESHOLD:
+        for statement, amount in stats.statements.items():
+            if amount > SQL_N_PLUS_ONE_THRESHOLD:
+                logger.warning(
+                    json.dumps(
+                        {
+                            "event": "n_plus_one",
+                            "path": request.path,
+                            "endpoint": request.endpoint,
+                            "times": amount,
+                            "sql": statement,
+                        }
+                    )
+                )
+
+    return response
+
+
+def init_instrumentation(app):
+    """Registers per-request SQL instrumentation on app"""
+
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
@@ -0,0 +1,185 @@
+# tullinge/booking
+# https://github.com/tullinge/booking
+
+# Live seat availability over Server-Sent Events. Whenever bookings change the
+# amount of available spaces, a message is published on SPACES_CHANNEL. Each
+# worker runs one fan-out thread that listens on the channel, reads the spaces
+# of all activities (at most once per LIVE_SPACES_INTERVAL, however many
+# bookings were made) and pushes the activities whose count changed to every
+# stream connected to that worker.
+#
+# A stream keeps its worker busy, so only enable LIVE_SPACES with a worker
+# class that serves many connections at once (threads or gevent).
+
+# imports
+import os
+import json
+from os import environ
+from queue import Queue, Empty, Full
+from time import monotonic, sleep
+from threading import Thread, Lock
+
+from redis.exceptions import RedisError
+
+# components import
+from components.catalogue import get_live_spaces
+from components.redis_obj import redis_client
+
+LIVE_SPACES = environ.get("LIVE_SPACES", "0") == "1"
+
+# seconds between reads of the spaces while bookings are being made
+LIVE_SPACES_INTERVAL = float(environ.get("LIVE_SPACES_INTERVAL", 1))
+
+# seconds a stream is kept open, the browser reconnects after that
+LIVE_SPACES_STREAM_SECONDS = float(environ.get("LIVE_SPACES_STREAM_SECONDS", 300))
+
+# seconds between comments keeping idle streams open through proxies
+HEARTBEAT_SECONDS = 15
+
+# updates queued for a client that is not reading before it is disconnected
+CLIENT_QUEUE_SIZE = 100
+
+SPACES_CHANNEL = "booking:spaces"
+
+_spaces = {}  # activity id -> available spaces, as last sent to clients
+_clients = set()  # queues of the streams connected to this worker
+_clients_lock = Lock()
+_fanout = {"pid": None}
+
+
+def spaces_changed():
+    """Tells all workers that available spaces have changed, call after commit"""
+
+    if not LIVE_SPACES:
+        return
+
+    try:
+        redis_client.publish(SPACES_CHANNEL, "changed")
+    except RedisError:
+        # clients see the change on their next page load
+        pass
+
+
+def _send(update):
+    with _clients_lock:
+        clients = list(_clients)
+
+    for client in clients:
+        try:
+            client.put_nowait(update)
+        except Full:
+            # stalled client, ends its stream
+            _disconnect(client)
+
+
+def _disconnect(client):
+    with _clients_lock:
+        _clients.discard(client)
+
+    # wake the stream up so it notices
+    try:
+        client.put_nowait(None)
+    except Full:
+        pass
+
+
+def _refresh():
+    """Reads the spaces and sends the activities that changed or were deleted"""
+
+    spaces = get_live_spaces()
+    update = {
+        activity_id: available
+        for activity_id, available in spaces.items()
+        if _spaces.get(activity_id) != available
+    }
+    update.update(
+        (activity_id, None) for activity_id in _spaces if activity_id not in spaces
+    )
+
+    _spaces.clear()
+    _spaces.update(spaces)
+
+    if update:
+        _send(update)
+
+
+def _fan_out():
+    """Listens for changes and sends updated spaces to the connected clients"""
+
+    while True:
+        try:
+            pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(SPACES_CHANNEL)
+
+            # changes may have been missed while not subscribed
+            _refresh()
+
+            while True:
+                if not pubsub.get_message(timeout=HEARTBEAT_SECONDS):
+                    continue
+
+                # coalesce the changes of LIVE_SPACES_INTERVAL into one read
+                sleep(LIVE_SPACES_INTERVAL)
+                while pubsub.get_message():
+                    pass
+
+                _refresh()
+        except Exception:
+            # Redis or the database is unavailable, try again
+            sleep(1)
+
+
+def _ensure_fan_out():
+    # one fan-out thread per worker process, started after gunicorn has forked
+    if _fanout["pid"] == os.getpid():
+        return
+
+    with _clients_lock:
+        if _fanout["pid"] != os.getpid():
+            _spaces.clear()
+            Thread(target=_fan_out, name="spaces-fan-out", daemon=True).start()
+            _fanout["pid"] = os.getpid()
+
+
+def _event(update):
+    return f"data: {json.dumps(update)}\n\n"
+
+
+def spaces_stream():
+    """
+    Yields Server-Sent Events with available spaces by activity id
+
+    The first event holds all activities known to the worker, the following
+    ones only the activities whose spaces changed.
+    """
+
+    _ensure_fan_out()
+
+    client = Queue(maxsize=CLIENT_QUEUE_SIZE)
+
+    with _clients_lock:
+        _clients.add(client)
+
+    try:
+        # reconnect after a few seconds when the stream ends
+        yield "retry: 5000\n\n"
+
+        if _spaces:
+            yield _event(dict(_spaces))
+
+        closes_at = monotonic() + LIVE_SPACES_STREAM_SECONDS
+
+        while monotonic() < closes_at:
+            try:
+                update = client.get(timeout=HEARTBEAT_SECONDS)
+            except Empty:
+                yield ": heartbeat\n\n"
+                continue
+
+            if update is None:
+                break
+
+            yield _event(update)
+    finally:
+        with _clients_lock:
+            _clients.discard(client)
@@ -0,0 +1,373 @@
+# tullinge/booking
+# https://github.com/tullinge/booking
+
+# Lottery allocation, an alternative to first-come booking. While the setting
+# allocation_mode is "lottery" students rank activities instead of booking
+# them. When the window has closed (booking locked) an admin runs the lottery,
+# which assigns activities by random serial dictatorship: students are put in
+# a random order and each in turn gets their highest ranked activity that still
+# has spaces left.
+#
+# Students answer the questions of the activities they rank on the activity
+# pages, a ranked activity only takes part in the lottery once answered. The
+# answers are stored with the ranking and written when the student is placed.
+
+# imports
+import json
+import random
+from os import environ
+from collections import Counter
+
+# components import
+from components.db import sql_query, dict_sql_query, transaction
+from components.settings import get_setting
+from components.live_spaces import spaces_changed
+from components.catalogue import get_catalogue
+from components.booking import answer_rows, answer_ids, valid_answer_rows
+
+FIRST_COME = "first_come"
+LOTTERY = "lottery"
+
+# amount of activities each student ranks
+LOTTERY_PREFERENCES = int(environ.get("LOTTERY_PREFERENCES", 3))
+
+# students booked per UPDATE when writing the result
+LOTTERY_CHUNK_SIZE = 1000
+
+# only one lottery may run at a time
+LOTTERY_LOCK = "booking_lottery"
+
+
+class LotteryRunning(Exception):
+    """Raised when another lottery is already running"""
+
+
+def allocation_mode():
+    """Returns FIRST_COME or LOTTERY"""
+
+    return LOTTERY if get_setting("allocation_mode") == LOTTERY else FIRST_COME
+
+
+def get_preferences(student_id):
+    """Returns ids of the activities student has ranked, most wanted first"""
+
+    return [
+        row["activity_id"]
+        for row in dict_sql_query(
+            "SELECT activity_id FROM preferences WHERE student_id = %s ORDER BY priority",
+            params=(student_id,),
+        )
+    ]
+
+
+def get_unanswered_preferences(student_id):
+    """Returns the ranked activities whose questions student has not answered"""
+
+    catalogue = get_catalogue()
+
+    return [
+        catalogue[row["activity_id"]]
+        for row in dict_sql_query(
+            "SELECT activity_id FROM preferences WHERE student_id = %s AND answers IS NULL ORDER BY priority",
+            params=(student_id,),
+        )
+        if row["activity_id"] in catalogue
+    ]
+
+
+def set_preferences(student_id, activity_ids):
+    """
+    Replaces the ranking of student, activity_ids most wanted first
+
+    Answers to activities that are still ranked are kept, activities without
+    questions need no answers.
+    """
+
+    catalogue = get_catalogue()
+
+    with transaction() as cursor:
+        cursor.execute(
+            "SELECT activity_id, answers FROM preferences WHERE student_id = %s",
+            (student_id,),
+        )
+        answers = {row["activity_id"]: row["answers"] for row in cursor.fetchall()}
+
+        cursor.execute("DELETE FROM preferences WHERE student_id = %s", (student_id,))
+
+        if activity_ids:
+            cursor.executemany(
+                "INSERT INTO preferences (student_id, activity_id, priority, answers) VALUES (%s, %s, %s, %s)",
+                [
+                    (
+                        student_id,
+                        activity_id,
+                        priority,
+                        answers.get(activity_id)
+                        or (
+                            None
+                            if catalogue.get(activity_id, {}).get("questions")
+                            else "[]"
+                        ),
+                    )
+                    for priority, activity_id in enumerate(activity_ids, start=1)
+                ],
+            )
+
+
+def set_preference_answers(student_id, activity_id, answers):
+    """
+    Stores the answers of student to the questions of a ranked activity
+
+    :param list answers: List of (question, answer) tuples, see book_activity
+    """
+
+    sql_query(
+        "UPDATE preferences SET answers = %s WHERE student_id = %s AND activity_id = %s",
+        params=(json.dumps(answer_rows(answers)), student_id, activity_id),
+    )
+
+
+def allocate(preferences, capacities, seed=None):
+    """
+    Assigns activities by random serial dictatorship
+
+    Runs in O(students * preferences), thousands of students take milliseconds.
+
+    :param dict preferences: Ranked activity ids by student id
+    :param dict capacities: Available spaces by activity id
+    :param seed: Seed for the random order, to reproduce a lottery
+    Returns dict of (activity id, rank) by student id, (None, None) if unassigned
+    """
+
+    order = sorted(preferences)
+    random.Random(seed).shuffle(order)
+
+    remaining = dict(capacities)
+    assignment = {}
+
+    for student_id in order:
+        assignment[student_id] = (None, None)
+
+        for rank, activity_id in enumerate(preferences[student_id], start=1):
+            if remaining.get(activity_id, 0) > 0:
+                remaining[activity_id] -= 1
+                assignment[student_id] = (activity_id, rank)
+                break
+
+    return assignment
+
+
+def allocation_metrics(assignment, classes=None):
+    """
+    Returns satisfaction and fairness metrics of an assignment (see allocate)
+
+    :param dict classes: Class name by student id, to compare classes
+    """
+
+    ranks = Counter(rank for _, rank in assignment.values())
+    students = len(assignment)
+    assigned = students - ranks.pop(None, 0)
+
+    metrics = {
+        "students": students,
+        "assigned": assigned,
+        "unassigned": students - assigned,
+        "rank_counts": dict(sorted(ranks.items())),
+        "first_choice_share": ranks.get(1, 0) / students if students else 0,
+        "mean_rank": (
+            sum(rank * amount for rank, amount in ranks.items()) / assigned
+            if assigned
+            else None
+        ),
+    }
+
+    if classes:
+        # share of first choices per class, a fair lottery keeps these close
+        per_class = {}
+        for student_id, (_, rank) in assignment.items():
+            total, first = per_class.get(classes.get(student_id), (0, 0))
+            per_class[classes.get(student_id)] = (total + 1, first + (rank == 1))
+
+        shares = [first / total for total, first in per_class.values()]
+        metrics["first_choice_share_by_class"] = {
+            "min": min(shares),
+            "max": max(shares),
+        }
+
+    return metrics
+
+
+def load_lottery(cursor):
+    """
+    Returns (preferences, capacities, classes) of the students taking part
+
+    Students that have already booked an activity keep it and are left out,
+    as are ranked activities whose questions the student has not answered.
+    The activities are locked until the transaction of cursor ends, so their
+    capacities can't change before the result has been written.
+    """
+
+    # locked first, the students are then read as left by any earlier run
+    cursor.execute(
+        "SELECT id, spaces - booked AS available_spaces FROM activities FOR UPDATE"
+    )
+    capacities = {row["id"]: row["available_spaces"] for row in cursor.fetchall()}
+
+    cursor.execute("""
+        SELECT preferences.student_id, preferences.activity_id, school_classes.class_name
+        FROM preferences
+        INNER JOIN students ON students.id = preferences.student_id
+        LEFT JOIN school_classes ON school_classes.id = students.class_id
+        WHERE students.chosen_activity IS NULL AND preferences.answers IS NOT NULL
+        ORDER BY preferences.student_id, preferences.priority
+        """)
+
+    preferences = {}
+    classes = {}
+
+    for row in cursor.fetchall():
+        preferences.setdefault(row["student_id"], []).append(row["activity_id"])
+        classes[row["student_id"]] = row["class_name"]
+
+    return preferences, capacities, classes
+
+
+def _write_answers(cursor, bookings, ids):
+    """Replaces the answers of placed students with those given when ranking"""
+
+    student_ids = [student_id for student_id, _ in bookings]
+    placeholders = ", ".join(["%s"] * len(student_ids))
+
+    cursor.execute(
+        f"SELECT student_id, activity_id, answers FROM preferences WHERE student_id IN ({placeholders})",
+        student_ids,
+    )
+    stored = {
+        (row["student_id"], row["activity_id"]): row["answers"]
+        for row in cursor.fetchall()
+    }
+
+    cursor.execute(
+        f"DELETE FROM answers WHERE student_id IN ({placeholders})", student_ids
+    )
+
+    rows = [
+        (student_id, *row)
+        for student_id, activity_id in bookings
+        for row in valid_answer_rows(
+            ids[activity_id], json.loads(stored.get((student_id, activity_id)) or "[]")
+        )
+    ]
+
+    if rows:
+        cursor.executemany(
+            "INSERT INTO answers (student_id, question_id, option_id, written_answer) VALUES (%s, %s, %s, %s)",
+            rows,
+        )
+
+
+def run_lottery(seed=None, dry_run=False):
+    """
+    Runs the lottery and books the assigned activities
+
+    Bookings are written in bulk in one transaction along with the answers
+    given when ranking, a student that has booked an activity in the meantime
+    keeps that booking. Should only be run while booking is locked. Raises
+    LotteryRunning if another lottery is running. Returns metrics, see
+    allocation_metrics.
+    """
+
+    with transaction() as cursor:
+        cursor.execute("SELECT GET_LOCK(%s, 0) AS locked", (LOTTERY_LOCK,))
+        if not cursor.fetchone()["locked"]:
+            raise LotteryRunning()
+
+        try:
+            metrics = _run_lottery(cursor, seed, dry_run)
+        finally:
+            # the activities stay locked until commit, a run waiting for the
+            # lock then reads the capacities this run has left
+            cursor.execute("SELECT RELEASE_LOCK(%s)", (LOTTERY_LOCK,))
+
+    if not dry_run:
+        spaces_changed()
+
+    return metrics
+
+
+def _run_lottery(cursor, seed, dry_run):
+    preferences, capacities, classes = load_lottery(cursor)
+    assignment = allocate(preferences, capacities, seed=seed)
+    metrics = allocation_metrics(assignment, classes)
+
+    if dry_run:
+        return metrics
+
+    bookings = [
+        (student_id, activity_id)
+        for student_id, (activity_id, _) in assignment.items()
+        if activity_id is not None
+    ]
+
+    activity_ids = list({activity_id for _, activity_id in bookings})
+
+    # questions and options the stored answers are checked against
+    ids = answer_ids(cursor, activity_ids)
+
+    for i in range(0, len(bookings), LOTTERY_CHUNK_SIZE):
+        chunk = bookings[i : i + LOTTERY_CHUNK_SIZE]
+
+        # students that booked an activity in the meantime keep it
+        cursor.execute(
+            f"SELECT id FROM students WHERE id IN ({', '.join(['%s'] * len(chunk))}) AND chosen_activity IS NULL FOR UPDATE",
+            [student_id for student_id, _ in chunk],
+        )
+        unbooked = {row["id"] for row in cursor.fetchall()}
+        chunk = [booking for booking in chunk if booking[0] in unbooked]
+
+        if not chunk:
+            continue
+
+        cursor.execute(
+            f"""
+            UPDATE students
+            SET chosen_activity = CASE id {" ".join(["WHEN %s THEN %s"] * len(chunk))} END,
+                attendance = 0
+            WHERE id IN ({", ".join(["%s"] * len(chunk))}) AND chosen_activity IS NULL
+            """,
+            [value for booking in chunk for value in booking]
+            + [student_id for student_id, _ in chunk],
+        )
+
+        _write_answers(cursor, chunk, ids)
+
+    if activity_ids:
+        placeholders = ", ".join(["%s"] * len(activity_ids))
+
+        # recount the activities that got students
+        cursor.execute(
+            f"""
+            UPDATE activities
+            LEFT JOIN (
+                SELECT chosen_activity, COUNT(*) AS amount
+                FROM students
+                WHERE chosen_activity IN ({placeholders})
+                GROUP BY chosen_activity
+            ) AS booked_students ON booked_students.chosen_activity = activities.id
+            SET activities.booked = COALESCE(booked_students.amount, 0)
+            WHERE activities.id IN ({placeholders})
+            """,
+            activity_ids + activity_ids,
+        )
+
+        # never commit an overbooked activity, rolls the whole run back
+        cursor.execute(
+            f"SELECT id FROM activities WHERE id IN ({placeholders}) AND booked > spaces",
+            activity_ids,
+        )
+        overbooked = [row["id"] for row in cursor.fetchall()]
+
+        if overbooked:
+            raise RuntimeError(f"lottery would overbook activities {overbooked}")
+
+    return metrics
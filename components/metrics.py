@@ -0,0 +1,279 @@
+# tullinge/booking
+# https://github.com/tullinge/booking
+
+# Prometheus metrics aggregated across workers in Redis. Counters and
+# histograms are incremented in Redis hashes (one pipeline per request), so
+# every worker serves the same totals. Per-worker gauges, like the database
+# pool, are written to a key per worker that expires when the worker is gone.
+# /metrics renders everything in the Prometheus text format and is only
+# served with METRICS_TOKEN to requests that did not come through the proxy.
+
+# imports
+import os
+import socket
+import secrets
+from os import environ
+from time import perf_counter
+
+from flask import g, request, abort, Response, has_app_context
+from redis.exceptions import RedisError
+
+# components import
+from components.db import pool
+from components.redis_obj import redis_client
+
+# bearer token Prometheus scrapes /metrics with, /metrics is disabled if unset
+METRICS_TOKEN = environ.get("METRICS_TOKEN")
+
+# blueprints whose requests are measured
+INSTRUMENTED_BLUEPRINTS = ["student_routes", "admin_routes", "activity_leader_routes"]
+
+KEY_PREFIX = "booking:metrics"
+
+# seconds the gauges of a worker are kept after its last request
+WORKER_TTL = 60
+
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+# name -> (type, help, histogram buckets)
+METRICS = {
+    "booking_http_requests_total": (
+        "counter",
+        "Requests by blueprint, route, method and status",
+        None,
+    ),
+    "booking_http_request_duration_seconds": (
+        "histogram",
+        "Request latency by blueprint and route",
+        LATENCY_BUCKETS,
+    ),
+    "booking_bookings_total": (
+        "counter",
+        "Booking attempts by result (booked, full, not_found)",
+        None,
+    ),
+    "booking_rate_limited_total": (
+        "counter",
+        "Requests rejected by the rate limiter",
+        None,
+    ),
+    "booking_oauth_request_duration_seconds": (
+        "histogram",
+        "Latency of requests to Google by endpoint",
+        LATENCY_BUCKETS,
+    ),
+}
+
+# per-worker gauges, name -> (help, attribute of the pool)
+POOL_GAUGES = {
+    "booking_db_pool_size": ("Maximum database connections per worker", "size"),
+    "booking_db_pool_open": ("Open database connections", "open"),
+    "booking_db_pool_in_use": ("Database connections leased to requests", "in_use"),
+    "booking_db_pool_timeouts": (
+        "Requests that got no database connection in time, since the worker started",
+        "timeouts",
+    ),
+}
+
+
+def _labels(labels):
+    """Returns labels in the Prometheus format, sorted by name"""
+
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    return ",".join(
+        f'{name}="{escape(value)}"' for name, value in sorted(labels.items())
+    )
+
+
+def _write(commands):
+    """Runs (method, args) commands in one pipeline, metrics are best effort"""
+
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+
+        for method, args in commands:
+            getattr(pipe, method)(*args)
+
+        pipe.execute()
+    except RedisError:
+        pass
+
+
+def _record(method, *args):
+    # collected during a request and written in one round trip when it ends
+    if has_app_context() and "metrics" in g:
+        g.metrics.append((method, args))
+    else:
+        _write([(method, args)])
+
+
+def inc(name, amount=1, **labels):
+    """Increments counter name"""
+
+    _record("hincrbyfloat", f"{KEY_PREFIX}:{name}", _labels(labels), amount)
+
+
+def observe(name, value, **labels):
+    """Observes value in histogram name"""
+
+    key = f"{KEY_PREFIX}:{name}"
+    field = _labels(labels)
+    buckets = METRICS[name][2]
+
+    # count in the first bucket value fits, buckets are summed when rendered
+    bucket = next((i for i, le in enumerate(buckets) if value <= le), len(buckets))
+
+    _record("hincrbyfloat", key, f"{field}|{bucket}", 1)
+    _record("hincrbyfloat", key, f"{field}|sum", value)
+
+
+def _pool_gauges():
+    with pool._condition:
+        return {
+            "size": pool.size,
+            "open": pool._open,
+            "in_use": pool._open - len(pool._idle),
+            "timeouts": pool.timeouts,
+        }
+
+
+def _start_request():
+    g.metrics = []
+    g.metrics_started = perf_counter()
+
+
+def _finish_request(response):
+    commands = g.pop("metrics", None)
+
+    if commands is None:
+        return response
+
+    if request.blueprint in INSTRUMENTED_BLUEPRINTS:
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        duration = perf_counter() - g.pop("metrics_started")
+
+        inc(
+            "booking_http_requests_total",
+            blueprint=request.blueprint,
+            route=route,
+            method=request.method,
+            status=response.status_code,
+        )
+        observe(
+            "booking_http_request_duration_seconds",
+            duration,
+            blueprint=request.blueprint,
+            route=route,
+        )
+
+    # pid read here, the app may have been loaded before gunicorn forked
+    worker_key = f"{KEY_PREFIX}:worker:{socket.gethostname()}:{os.getpid()}"
+    commands.append(("hset", (worker_key, None, None, _pool_gauges())))
+    commands.append(("expire", (worker_key, WORKER_TTL)))
+
+    _write(commands)
+
+    return response
+
+
+def _render_counter(lines, name, values):
+    for labels, value in sorted(values.items()):
+        lines.append(f"{name}{{{labels}}} {value}")
+
+
+def _render_histogram(lines, name, values, buckets):
+    series = {}
+
+    for field, value in values.items():
+        labels, part = field.rsplit("|", 1)
+        series.setdefault(labels, {})[part] = value
+
+    for labels, parts in sorted(series.items()):
+        prefix = f"{labels}," if labels else ""
+        count = 0
+
+        for i, le in enumerate(buckets + ["+Inf"]):
+            count += parts.get(str(i), 0)
+            lines.append(f'{name}_bucket{{{prefix}le="{le}"}} {count}')
+
+        lines.append(f"{name}_sum{{{labels}}} {parts.get('sum', 0)}")
+        lines.append(f"{name}_count{{{labels}}} {count}")
+
+
+def render_metrics():
+    """Returns all metrics in the Prometheus text format"""
+
+    pipe = redis_client.pipeline(transaction=False)
+    for name in METRICS:
+        pipe.hgetall(f"{KEY_PREFIX}:{name}")
+    results = pipe.execute()
+
+    lines = []
+
+    for (name, (kind, description, buckets)), result in zip(METRICS.items(), results):
+        values = {
+            field.decode("utf-8"): float(value) for field, value in result.items()
+        }
+
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {kind}")
+
+        if kind == "histogram":
+            _render_histogram(lines, name, values, buckets)
+        else:
+            _render_counter(lines, name, values)
+
+    workers = {}
+    for key in redis_client.scan_iter(f"{KEY_PREFIX}:worker:*"):
+        worker = key.decode("utf-8").split(":worker:", 1)[1]
+        workers[worker] = {
+            field.decode("utf-8"): float(value)
+            for field, value in redis_client.hgetall(key).items()
+        }
+
+    for name, (description, attribute) in POOL_GAUGES.items():
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} gauge")
+
+        for worker, gauges in sorted(workers.items()):
+            if attribute in gauges:
+                lines.append(
+                    f"{name}{{{_labels({'worker': worker})}}} {gauges[attribute]}"
+                )
+
+    return "\n".join(lines) + "\n"
+
+
+def metrics():
+    """
+    Metrics
+
+    * all metrics in the Prometheus text format (GET)
+    * requires the Authorization header "Bearer METRICS_TOKEN"
+    * never served through the reverse proxy (X-Forwarded-For set)
+    """
+
+    if not METRICS_TOKEN or request.headers.get("X-Forwarded-For"):
+        abort(404)
+
+    if not secrets.compare_digest(
+        request.headers.get("Authorization", ""), f"Bearer {METRICS_TOKEN}"
+    ):
+        abort(404)
+
+    try:
+        body = render_metrics()
+    except RedisError:
+        abort(503)
+
+    return Response(body, mimetype="text/plain; version=0.0.4")
+
+
+def init_metrics(app):
+    """Measures requests to the instrumented blueprints and serves /metrics"""
+
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    app.add_url_rule("/metrics", "metrics", metrics)
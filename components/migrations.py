@@ -0,0 +1,250 @@
+# tullinge/booking
+# https://github.com/tullinge/booking
+
+# Versioned schema migrations. Every migration runs once per database, the
+# applied versions are recorded in schema_migrations. Steps check the current
+# schema before changing it, so a migration interrupted halfway (MySQL commits
+# DDL implicitly) can simply be run again.
+#
+# Add new migrations to the end of MIGRATIONS, never change applied ones.
+
+# imports
+import pymysql
+
+# components import
+from components.db import create_conn
+
+# only one process may migrate at a time
+MIGRATION_LOCK = "booking_schema_migrations"
+MIGRATION_LOCK_TIMEOUT = 60
+
+INDEXES = [
+    ("students", "ix_students_chosen_activity", "chosen_activity"),
+    ("students", "ix_students_class_id", "class_id"),
+    ("answers", "ix_answers_student_id", "student_id"),
+    ("answers", "ix_answers_question_id", "question_id"),
+    ("questions", "ix_questions_activity_id", "activity_id"),
+    ("options", "ix_options_question_id", "question_id"),
+    ("leaders", "ix_leaders_email", "email"),
+    ("leaders", "ix_leaders_activity_id", "activity_id"),
+]
+
+# (table, constraint, column, referenced table, on delete)
+FOREIGN_KEYS = [
+    ("questions", "fk_questions_activity", "activity_id", "activities", "CASCADE"),
+    ("options", "fk_options_question", "question_id", "questions", "CASCADE"),
+    ("answers", "fk_answers_student", "student_id", "students", "CASCADE"),
+    ("answers", "fk_answers_question", "question_id", "questions", "CASCADE"),
+    ("answers", "fk_answers_option", "option_id", "options", "CASCADE"),
+    ("students", "fk_students_class", "class_id", "school_classes", "SET NULL"),
+    ("students", "fk_students_activity", "chosen_activity", "activities", "SET NULL"),
+    ("leaders", "fk_leaders_activity", "activity_id", "activities", "CASCADE"),
+]
+
+
+def _exists(cursor, query, params):
+    cursor.execute(query, params)
+    return cursor.fetchone() is not None
+
+
+def column_exists(cursor, table, column):
+    return _exists(
+        cursor,
+        "SELECT 1 FROM information_schema.columns WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s",
+        (table, column),
+    )
+
+
+def index_exists(cursor, table, index):
+    return _exists(
+        cursor,
+        "SELECT 1 FROM information_schema.statistics WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s",
+        (table, index),
+    )
+
+
+def foreign_key_exists(cursor, table, constraint):
+    return _exists(
+        cursor,
+        "SELECT 1 FROM information_schema.table_constraints WHERE table_schema = DATABASE() AND table_name = %s AND constraint_name = %s AND constraint_type = 'FOREIGN KEY'",
+        (table, constraint),
+    )
+
+
+def add_booked_counter(cursor):
+    """Adds activities.booked and counts the existing bookings"""
+
+    if column_exists(cursor, "activities", "booked"):
+        return
+
+    cursor.execute(
+        "ALTER TABLE activities ADD COLUMN booked INT NOT NULL DEFAULT 0 AFTER info"
+    )
+    cursor.execute("""
+        UPDATE activities
+        SET booked = (
+            SELECT COUNT(*) FROM students WHERE students.chosen_activity = activities.id
+        )
+        """)
+
+
+def add_indexes(cursor):
+    """Indexes the columns bookings, rosters and logins filter on"""
+
+    for table, index, column in INDEXES:
+        if not index_exists(cursor, table, index):
+            cursor.execute(f"CREATE INDEX {index} ON {table} ({column})")
+
+
+def remove_orphans(cursor):
+    """Removes (or unsets) references to deleted rows, they would block the foreign keys"""
+
+    for table, _, column, referenced_table, on_delete in FOREIGN_KEYS:
+        join = (
+            f"LEFT JOIN {referenced_table} ON {referenced_table}.id = {table}.{column}"
+        )
+        where = f"WHERE {table}.{column} IS NOT NULL AND {referenced_table}.id IS NULL"
+
+        if on_delete == "CASCADE":
+            cursor.execute(f"DELETE {table} FROM {table} {join} {where}")
+        else:
+            cursor.execute(f"UPDATE {table} {join} SET {table}.{column} = NULL {where}")
+
+
+def add_foreign_keys(cursor):
+    """
+    Adds foreign keys, deleting activities, questions, options, students and
+    classes now also deletes (or unsets) everything referencing them
+    """
+
+    remove_orphans(cursor)
+
+    for table, constraint, column, referenced_table, on_delete in FOREIGN_KEYS:
+        if not foreign_key_exists(cursor, table, constraint):
+            cursor.execute(
+                f"ALTER TABLE {table} ADD CONSTRAINT {constraint} FOREIGN KEY ({column}) "
+                f"REFERENCES {referenced_table} (id) ON DELETE {on_delete}"
+            )
+
+
+def add_preferences(cursor):
+    """Adds the ranked preferences of the lottery allocation mode"""
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS preferences (
+            student_id INT NOT NULL,
+            activity_id INT NOT NULL,
+            priority INT NOT NULL,
+            PRIMARY KEY (student_id, priority),
+            UNIQUE KEY uq_preferences_activity (student_id, activity_id),
+            INDEX ix_preferences_activity_id (activity_id),
+            CONSTRAINT fk_preferences_student FOREIGN KEY (student_id)
+                REFERENCES students (id) ON DELETE CASCADE,
+            CONSTRAINT fk_preferences_activity FOREIGN KEY (activity_id)
+                REFERENCES activities (id) ON DELETE CASCADE
+        )
+        """)
+    cursor.execute(
+        "INSERT IGNORE INTO settings (identifier, value) VALUES ('allocation_mode', 'first_come')"
+    )
+
+
+def add_waitlist(cursor):
+    """Adds the waitlist of full activities, one entry per student"""
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS waitlist (
+            id INT NOT NULL AUTO_INCREMENT,
+            student_id INT NOT NULL,
+            activity_id INT NOT NULL,
+            answers TEXT NOT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (id),
+            UNIQUE KEY uq_waitlist_student (student_id),
+            INDEX ix_waitlist_activity_id (activity_id, id),
+            CONSTRAINT fk_waitlist_student FOREIGN KEY (student_id)
+                REFERENCES students (id) ON DELETE CASCADE,
+            CONSTRAINT fk_waitlist_activity FOREIGN KEY (activity_id)
+                REFERENCES activities (id) ON DELETE CASCADE
+        )
+        """)
+
+
+def add_preference_answers(cursor):
+    """
+    Adds the answers students give to the questions of the activities they
+    rank, NULL until answered
+    """
+
+    if column_exists(cursor, "preferences", "answers"):
+        return
+
+    cursor.execute("ALTER TABLE preferences ADD COLUMN answers TEXT NULL")
+
+
+# (version, name, function), applied in order
+MIGRATIONS = [
+    (1, "add booked counter", add_booked_counter),
+    (2, "add indexes", add_indexes),
+    (3, "add foreign keys", add_foreign_keys),
+    (4, "add lottery preferences", add_preferences),
+    (5, "add waitlist", add_waitlist),
+    (6, "add preference answers", add_preference_answers),
+]
+
+
+def _applied_versions(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INT NOT NULL,
+            name VARCHAR(255) NOT NULL,
+            applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (version)
+        )
+        """)
+    cursor.execute("SELECT version FROM schema_migrations")
+
+    return {row["version"] for row in cursor.fetchall()}
+
+
+def migrate(log=print):
+    """
+    Applies all pending migrations, returns list of applied versions
+
+    Uses a dedicated connection holding a named lock, so concurrently started
+    processes do not migrate the same database twice.
+    """
+
+    conn = create_conn()
+    conn.autocommit(True)
+
+    try:
+        with conn.cursor(pymysql.cursors.DictCursor) as cursor:
+            cursor.execute(
+                "SELECT GET_LOCK(%s, %s) AS locked",
+                (MIGRATION_LOCK, MIGRATION_LOCK_TIMEOUT),
+            )
+            if not cursor.fetchone()["locked"]:
+                raise RuntimeError("another process is migrating the database")
+
+            applied_versions = _applied_versions(cursor)
+            applied = []
+
+            for version, name, migration in MIGRATIONS:
+                if version in applied_versions:
+                    continue
+
+                log(f"applying migration {version}: {name}")
+                migration(cursor)
+
+                cursor.execute(
+                    "INSERT INTO schema_migrations (version, name) VALUES (%s, %s)",
+                    (version, name),
+                )
+                applied.append(version)
+
+            cursor.execute("SELECT RELEASE_LOCK(%s)", (MIGRATION_LOCK,))
+
+            return applied
+    finally:
+        conn.close()
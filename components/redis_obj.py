@@ -0,0 +1,13 @@
+# tullinge/booking
+# https://github.com/tullinge/booking
+
+# imports
+from os import environ
+import redis
+
+redis_client = redis.Redis(
+    host=environ.get("REDIS_HOST", "localhost"),
+    db=0,
+    socket_timeout=float(environ.get("REDIS_TIMEOUT", 2)),
+    socket_connect_timeout=float(environ.get("REDIS_TIMEOUT", 2)),
+)
@@ -0,0 +1,248 @@
+# tullinge/booking
+# https://github.com/tullinge/booking
+
+# imports
+from os import environ
+
+# components import
+from components.db import dict_sql_query
+from components.catalogue import get_catalogue
+
+# students per page on the admin students list
+STUDENTS_PAGE_SIZE = int(environ.get("STUDENTS_PAGE_SIZE", 100))
+
+# booking statuses students can be filtered by
+STUDENT_STATUSES = {
+    "booked": "students.chosen_activity IS NOT NULL",
+    "not_booked": "students.chosen_activity IS NULL AND students.class_id IS NOT NULL",
+    "no_class": "students.class_id IS NULL",
+}
+
+
+def _placeholders(values):
+    return ", ".join(["%s"] * len(values))
+
+
+def get_answers(activity_ids):
+    """
+    Returns answers of students booked to any of activity_ids
+
+    Option answers are resolved to the option text in the same query.
+
+    :param list activity_ids: Ids of activities
+    Returns dict of {question_id: answer text} by student id
+    """
+
+    answers = {}
+
+    for row in dict_sql_query(
+        f"""
+        SELECT answers.student_id, answers.question_id, answers.written_answer,
+            options.text AS option_text
+        FROM answers
+        INNER JOIN students ON students.id = answers.student_id
+        LEFT JOIN options ON options.id = answers.option_id
+        WHERE students.chosen_activity IN ({_placeholders(activity_ids)})
+        """,
+        params=list(activity_ids),
+    ):
+        answers.setdefault(row["student_id"], {})[row["question_id"]] = (
+            row["option_text"]
+            if row["written_answer"] is None
+            else row["written_answer"]
+        )
+
+    return answers
+
+
+def get_rosters(activity_ids):
+    """
+    Returns students booked to each of activity_ids along with class name and answers
+
+    Uses two queries regardless of the amount of activities, students and
+    questions. Answers are ordered like the activity's questions (by question
+    id), unanswered questions are None.
+
+    :param list activity_ids: Ids of activities
+    Returns dict of lists of {"student", "class_name", "answers"} by activity id
+    """
+
+    rosters = {activity_id: [] for activity_id in activity_ids}
+    if not rosters:
+        return rosters
+
+    catalogue = get_catalogue()
+    answers = get_answers(activity_ids)
+
+    for student in dict_sql_query(
+        f"""
+        SELECT students.*, school_classes.class_name
+        FROM students
+        LEFT JOIN school_classes ON school_classes.id = students.class_id
+        WHERE students.chosen_activity IN ({_placeholders(activity_ids)})
+        ORDER BY students.id
+        """,
+        params=list(activity_ids),
+    ):
+        activity = catalogue.get(student["chosen_activity"], {"questions": []})
+        student_answers = answers.get(student["id"], {})
+
+        rosters[student["chosen_activity"]].append(
+            {
+                "student": student,
+                "class_name": student.pop("class_name"),
+                "answers": [
+                    student_answers.get(question["info"]["id"])
+                    for question in activity["questions"]
+                ],
+            }
+        )
+
+    return rosters
+
+
+def get_leader_rosters(email):
+    """
+    Returns rosters of all activities led by email
+
+    Returns list of {"name", "questions", "students"}, ordered by activity id
+    """
+
+    activity_ids = [
+        row["activity_id"]
+        for row in dict_sql_query(
+            "SELECT DISTINCT activity_id FROM leaders WHERE email = %s ORDER BY activity_id",
+            params=(email,),
+        )
+    ]
+
+    catalogue = get_catalogue()
+    rosters = get_rosters(activity_ids)
+
+    return [
+        {
+            "name": catalogue[activity_id]["name"],
+            "questions": [
+                question["info"] for question in catalogue[activity_id]["questions"]
+            ],
+            "students": rosters[activity_id],
+        }
+        for activity_id in activity_ids
+        if activity_id in catalogue
+    ]
+
+
+def get_activity_roster(activity_id):
+    """
+    Returns roster of a single activity, or None if the activity does not exist
+
+    Returns {"activity", "questions", "students"}, see get_rosters
+    """
+
+    activity = get_catalogue().get(int(activity_id))
+    if not activity:
+        return None
+
+    return {
+        "activity": activity,
+        "questions": [question["info"] for question in activity["questions"]],
+        "students": get_rosters([activity["id"]])[activity["id"]],
+    }
+
+
+def get_class_roster(class_id):
+    """
+    Returns students of school class along with the name of their booked activity
+
+    Returns list of {"student", "activity_name"}, activity_name is None if the
+    student has not booked any activity
+    """
+
+    return [
+        {"student": student, "activity_name": student.pop("activity_name")}
+        for student in dict_sql_query(
+            """
+            SELECT students.*, activities.name AS activity_name
+            FROM students
+            LEFT JOIN activities ON activities.id = students.chosen_activity
+            WHERE students.class_id = %s
+            ORDER BY students.id
+            """,
+            params=(class_id,),
+        )
+    ]
+
+
+def get_students_page(
+    search=None, status=None, after=None, before=None, limit=STUDENTS_PAGE_SIZE
+):
+    """
+    Returns one page of students along with class and activity name
+
+    Pages are keyset paginated on student id, so every page costs one indexed
+    query no matter how far into the list it is.
+
+    :param str search: Only students whose name, email or class contains this
+    :param str status: Only students with this booking status (see STUDENT_STATUSES)
+    :param int after: Return the page after this student id
+    :param int before: Return the page before this student id
+    :param int limit: Amount of students per page
+    Returns (list of {"student", "class_name", "activity_name"}, has_previous, has_next)
+    """
+
+    conditions = []
+    params = []
+
+    if search:
+        pattern = "%{}%".format(
+            search.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        )
+        conditions.append(
+            "(CONCAT(students.first_name, ' ', students.last_name) LIKE %s"
+            " OR students.email LIKE %s OR school_classes.class_name LIKE %s)"
+        )
+        params += [pattern] * 3
+
+    if status:
+        conditions.append(STUDENT_STATUSES[status])
+
+    if before is not None:
+        conditions.append("students.id < %s")
+        params.append(before)
+    elif after is not None:
+        conditions.append("students.id > %s")
+        params.append(after)
+
+    rows = dict_sql_query(
+        f"""
+        SELECT students.*, school_classes.class_name, activities.name AS activity_name
+        FROM students
+        LEFT JOIN school_classes ON school_classes.id = students.class_id
+        LEFT JOIN activities ON activities.id = students.chosen_activity
+        {"WHERE " + " AND ".join(conditions) if conditions else ""}
+        ORDER BY students.id {"DESC" if before is not None else "ASC"}
+        LIMIT %s
+        """,
+        params=params + [limit + 1],
+    )
+
+    # one extra row tells whether there is another page in this direction
+    more = len(rows) > limit
+    rows = rows[:limit]
+
+    if before is not None:
+        rows.reverse()
+        has_previous, has_next = more, True
+    else:
+        has_previous, has_next = after is not None, more
+
+    students = [
+        {
+            "student": row,
+            "class_name": row.pop("class_name"),
+            "activity_name": row.pop("activity_name"),
+        }
+        for row in rows
+    ]
+
+    return students, has_previous, has_next
@@ -0,0 +1,99 @@
+# tullinge/booking
+# https://github.com/tullinge/booking
+
+# imports
+import os
+from os import environ
+from time import monotonic, sleep
+from threading import Thread, Lock
+
+from redis.exceptions import RedisError
+
+# components import
+from components.db import dict_sql_query, sql_query
+from components.redis_obj import redis_client
+
+# seconds a worker may use a cached setting without asking the database
+SETTINGS_CACHE_SECONDS = float(environ.get("SETTINGS_CACHE_SECONDS", 5))
+
+SETTINGS_CHANNEL = "booking:settings"
+
+_cache = {}  # identifier -> (value, fetched_at)
+_listener = {"pid": None}
+_listener_lock = Lock()
+
+
+def _listen():
+    """Drops cached settings when another worker publishes a change"""
+
+    while True:
+        try:
+            pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(SETTINGS_CHANNEL)
+
+            # changes may have been missed while not subscribed
+            _cache.clear()
+
+            while True:
+                message = pubsub.get_message(timeout=1.0)
+
+                if message:
+                    _cache.pop(message["data"].decode("utf-8"), None)
+        except RedisError:
+            _cache.clear()
+            sleep(1)
+
+
+def _ensure_listener():
+    # one listener per worker process, started after gunicorn has forked
+    if _listener["pid"] == os.getpid():
+        return
+
+    with _listener_lock:
+        if _listener["pid"] != os.getpid():
+            Thread(target=_listen, name="settings-listener", daemon=True).start()
+            _listener["pid"] = os.getpid()
+
+
+def get_setting(identifier):
+    """Returns value of setting, cached for at most SETTINGS_CACHE_SECONDS"""
+
+    _ensure_listener()
+
+    cached = _cache.get(identifier)
+    if cached and monotonic() - cached[1] < SETTINGS_CACHE_SECONDS:
+        return cached[0]
+
+    setting = dict_sql_query(
+        "SELECT value FROM settings WHERE identifier = %s",
+        fetchone=True,
+        params=(identifier,),
+    )
+    value = setting["value"] if setting else None
+
+    _cache[identifier] = (value, monotonic())
+
+    return value
+
+
+def set_setting(identifier, value):
+    """Updates setting and tells all workers to drop their cached value"""
+
+    sql_query(
+        "UPDATE settings SET value = %s WHERE identifier = %s",
+        params=(value, identifier),
+    )
+
+    _cache.pop(identifier, None)
+
+    try:
+        redis_client.publish(SETTINGS_CHANNEL, identifier)
+    except RedisError:
+        # other workers pick up the change when their cache expires
+        pass
+
+
+def booking_locked():
+    """Returns boolean whether booking is locked for students"""
+
+    return get_setting("booking_locked") == "1"
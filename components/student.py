@@ -2,27 +2,72 @@
 # https://github.com/tullinge/booking
 
 # imports
-from flask import session
+from os import environ
+from time import time
+from flask import g, session
 
 # components import
 from components.db import dict_sql_query
+from components.catalogue import get_catalogue_activity
 
+# seconds the student snapshot in the session is trusted, 0 always asks the database
+STUDENT_SESSION_TRUST_SECONDS = int(environ.get("STUDENT_SESSION_TRUST_SECONDS", 0))
 
-def student_chosen_activity():
-    """Returns dict of chosen activity, if student has chosen"""
 
-    student = dict_sql_query(
-        "SELECT * FROM students WHERE id = %s",
-        fetchone=True,
-        params=(session.get("id"),),
-    )
+def get_student():
+    """
+    Returns dict of the logged in student, None if the student does not exist
+
+    Loaded at most once per request and shared through flask.g by decorators
+    and helpers. If STUDENT_SESSION_TRUST_SECONDS is set, a snapshot kept in
+    the (server-side) session is used for that many seconds before the
+    database is asked again.
+    """
+
+    if "student" in g:
+        return g.student
 
-    return (
-        dict_sql_query(
-            "SELECT * FROM activities WHERE id = %s",
-            params=(student["chosen_activity"],),
+    snapshot = session.get("student_snapshot")
+
+    if (
+        STUDENT_SESSION_TRUST_SECONDS
+        and snapshot
+        and snapshot["student"]["id"] == session.get("id")
+        and time() - snapshot["checked_at"] < STUDENT_SESSION_TRUST_SECONDS
+    ):
+        student = snapshot["student"]
+    else:
+        student = dict_sql_query(
+            "SELECT * FROM students WHERE id = %s",
             fetchone=True,
+            params=(session.get("id"),),
         )
-        if student["chosen_activity"]
-        else None
+
+        if STUDENT_SESSION_TRUST_SECONDS and student:
+            session["student_snapshot"] = {"student": student, "checked_at": time()}
+
+    g.student = student
+
+    return student
+
+
+def forget_student():
+    """Drops the loaded student, call after the student's row has been updated"""
+
+    g.pop("student", None)
+    session.pop("student_snapshot", None)
+
+
+def student_chosen_activity():
+    """Returns dict of chosen activity, if student has chosen"""
+
+    student = get_student()
+
+    if not student["chosen_activity"]:
+        return None
+
+    return get_catalogue_activity(student["chosen_activity"]) or dict_sql_query(
+        "SELECT * FROM activities WHERE id = %s",
+        params=(student["chosen_activity"],),
+        fetchone=True,
     )
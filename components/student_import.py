@@ -0,0 +1,178 @@
+# tullinge/booking
+# https://github.com/tullinge/booking
+
+# imports
+import csv
+from itertools import islice
+
+# components import
+from components.db import transaction
+from components.codes import insert_school_classes
+from components.validation import valid_string, valid_email
+
+# rows validated and written per batch
+IMPORT_CHUNK_SIZE = 500
+
+# vklass export columns
+CLASS_COLUMN = "titleTextBox"
+EMAIL_COLUMN = "htmlTextBox9"
+NAME_COLUMN = "htmlTextBox1"
+
+
+def parse_vklass_row(row):
+    """
+    Returns (class_name, email, first_name, last_name) of a vklass CSV row
+
+    Raises ValueError with a message for the admin if the row is invalid.
+    """
+
+    if None in row or None in row.values():
+        raise ValueError("Rad har fel antal kolumner.")
+
+    try:
+        class_name = row[CLASS_COLUMN].split(" ")[1].upper()
+        email = row[EMAIL_COLUMN].strip()
+        first_name, last_name = row[NAME_COLUMN].split(" ")[0:2]
+    except (IndexError, ValueError):
+        raise ValueError("Saknar klass eller för- och efternamn.")
+
+    # check that class name is valid
+    if not valid_string(
+        class_name,
+        min_length=3,
+        max_length=10,
+        allow_space=False,
+        allow_newline=False,
+        allow_punctuation=False,
+    ):
+        raise ValueError(f"Ogiltigt klassnamn {class_name}.")
+
+    # check that email is valid
+    if len(email) > 255 or not valid_email(email):
+        raise ValueError("Ogiltig e-post.")
+
+    if len(first_name) > 50 or len(last_name) > 50:
+        raise ValueError("För långt namn.")
+
+    return class_name, email, first_name, last_name
+
+
+def _ensure_classes(cursor, class_names, class_ids):
+    """
+    Fills class_ids (class name -> id) for class_names, creating missing
+    classes with one batched insert. Returns amount of created classes.
+    """
+
+    missing = [name for name in class_names if name not in class_ids]
+    if not missing:
+        return 0
+
+    placeholders = ", ".join(["%s"] * len(missing))
+    query = f"SELECT id, class_name FROM school_classes WHERE class_name IN ({placeholders})"
+
+    cursor.execute(query, missing)
+    for row in cursor.fetchall():
+        class_ids[row["class_name"].upper()] = row["id"]
+
+    new_classes = [name for name in missing if name not in class_ids]
+    if not new_classes:
+        return 0
+
+    insert_school_classes(cursor, new_classes)
+
+    cursor.execute(query, missing)
+    for row in cursor.fetchall():
+        class_ids[row["class_name"].upper()] = row["id"]
+
+    return len(new_classes)
+
+
+def _upsert_students(cursor, students, class_ids, known_students):
+    """
+    Creates students and sets class on existing students without one.
+    Returns amount of created or updated students.
+    """
+
+    emails = list(
+        {email.lower() for _, email, _, _ in students} - known_students.keys()
+    )
+    if emails:
+        cursor.execute(
+            f"SELECT email, class_id FROM students WHERE email IN ({', '.join(['%s'] * len(emails))})",
+            emails,
+        )
+        for row in cursor.fetchall():
+            known_students[row["email"].lower()] = row["class_id"]
+
+    changed = 0
+    for class_name, email, _, _ in students:
+        if known_students.get(email.lower()) is None:
+            changed += 1
+            known_students[email.lower()] = class_ids[class_name]
+
+    cursor.executemany(
+        "INSERT INTO students (first_name, last_name, email, class_id) VALUES (%s, %s, %s, %s) "
+        "ON DUPLICATE KEY UPDATE class_id = IFNULL(class_id, VALUES(class_id))",
+        [
+            (first_name, last_name, email, class_ids[class_name])
+            for class_name, email, first_name, last_name in students
+        ],
+    )
+
+    return changed
+
+
+def import_students(lines):
+    """
+    Imports students (and their classes) from a vklass CSV export
+
+    Rows are read as a stream and written in chunks of IMPORT_CHUNK_SIZE,
+    all within one transaction. Invalid rows are skipped and reported.
+
+    :param lines: Iterable of CSV lines (str), e.g. a decoded upload stream
+    Returns dict with amount of created classes, created/updated students and
+    list of (line number, message) for skipped rows. Raises ValueError if
+    the file is missing required columns.
+    """
+
+    reader = csv.DictReader(lines)
+
+    missing_columns = [
+        column
+        for column in [CLASS_COLUMN, EMAIL_COLUMN, NAME_COLUMN]
+        if column not in (reader.fieldnames or [])
+    ]
+    if missing_columns:
+        raise ValueError(f"Filen saknar kolumner: {', '.join(missing_columns)}.")
+
+    result = {"classes": 0, "students": 0, "errors": []}
+    class_ids = {}
+    known_students = {}  # lowercase email -> class_id
+
+    with transaction() as cursor:
+        while True:
+            chunk = list(islice(reader, IMPORT_CHUNK_SIZE))
+            if not chunk:
+                break
+
+            # header is line 1
+            first_line = reader.line_num - len(chunk) + 1
+
+            students = []
+            for i, row in enumerate(chunk):
+                try:
+                    students.append(parse_vklass_row(row))
+                except ValueError as e:
+                    result["errors"].append((first_line + i, str(e)))
+
+            if not students:
+                continue
+
+            result["classes"] += _ensure_classes(
+                cursor, {student[0] for student in students}, class_ids
+            )
+            result["students"] += _upsert_students(
+                cursor, students, class_ids, known_students
+            )
+
+    return result
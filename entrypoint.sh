@@ -11,4 +11,18 @@ if [[ "$SECRET_KEY" == "random" ]]; then
     export SECRET_KEY="$RANDOM_KEY"
 fi
 
-.venv/bin/gunicorn --workers=4 --bind 0.0.0.0:"$PORT" main:app
+# worker mode, see README: sync (default), gthread or gevent
+GUNICORN_WORKER_CLASS="${GUNICORN_WORKER_CLASS:-sync}"
+GUNICORN_WORKERS="${GUNICORN_WORKERS:-4}"
+GUNICORN_THREADS="${GUNICORN_THREADS:-1}"
+GUNICORN_WORKER_CONNECTIONS="${GUNICORN_WORKER_CONNECTIONS:-1000}"
+GUNICORN_TIMEOUT="${GUNICORN_TIMEOUT:-30}"
+
+.venv/bin/gunicorn \
+    --worker-class="$GUNICORN_WORKER_CLASS" \
+    --workers="$GUNICORN_WORKERS" \
+    --threads="$GUNICORN_THREADS" \
+    --worker-connections="$GUNICORN_WORKER_CONNECTIONS" \
+    --timeout="$GUNICORN_TIMEOUT" \
+    --bind 0.0.0.0:"$PORT" \
+    main:app
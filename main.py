@@ -2,7 +2,7 @@
 # https://github.com/tullinge/booking
 
 from os import environ
-from flask import Flask, render_template
+from flask import Flask, render_template, request
 from flask_minify import minify
 from datetime import timedelta
 from time import strftime
@@ -20,25 +20,37 @@ from routes.student import student_routes
 from routes.activity_leader import activity_leader_routes
 
 # components
-from components.db import dict_sql_query
+from components.db import init_db
+from components.instrumentation import init_instrumentation
+from components.metrics import init_metrics, inc
+from components.settings import get_setting
 
 # variables
 from components.google import GOOGLE_CLIENT_ID, GSUITE_DOMAIN_NAME
 
 # redis
-import redis
+from components.redis_obj import redis_client
 
 # flask application
 app = Flask(__name__)
 
 # setup rate limit
-app.config[
-    "RATELIMIT_STORAGE_URI"
-] = f"redis://{environ.get('REDIS_HOST', 'localhost')}"
+app.config["RATELIMIT_STORAGE_URI"] = environ.get(
+    "RATELIMIT_STORAGE_URI", f"redis://{environ.get('REDIS_HOST', 'localhost')}"
+)
 limiter.init_app(app)
 
-# minify
-minify(app=app)
+# database connection per request
+init_db(app)
+
+# database numbers per request (Server-Timing, logs)
+init_instrumentation(app)
+
+# request metrics aggregated across workers, served on /metrics
+init_metrics(app)
+
+# minify (the student index is minified in fragments, see components/fragments.py)
+minify(app=app, bypass=[r"^student_routes\.index$"])
 
 # custom footer
 CUSTOM_FOOTER = environ.get("CUSTOM_FOOTER", default=False)
@@ -54,10 +66,7 @@ def inject_global_variables():
         GOOGLE_CLIENT_ID=GOOGLE_CLIENT_ID,
         GSUITE_DOMAIN_NAME=GSUITE_DOMAIN_NAME,
         CUSTOM_FOOTER=CUSTOM_FOOTER,
-        BOOKING_LOCKED=dict_sql_query(
-            "SELECT value FROM settings WHERE identifier='booking_locked'",
-            fetchone=True,
-        )["value"],
+        BOOKING_LOCKED=get_setting("booking_locked"),
     )
 
 
@@ -79,6 +88,7 @@ def error_405(e):
 
 @app.errorhandler(429)
 def error_429(e):
+    inc("booking_rate_limited_total", blueprint=request.blueprint or "")
     return render_template("errors/429.html", msg=str(e)), 429
 
 
@@ -89,7 +99,7 @@ def error_500(e):
 
 # session setup
 SESSION_TYPE = "redis"
-SESSION_REDIS = redis.Redis(host=environ.get("REDIS_HOST", "localhost"), db=0)
+SESSION_REDIS = redis_client
 
 SESSION_COOKIE_SECURE = True
 SESSION_PERMANENT = True
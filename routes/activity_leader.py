@@ -7,6 +7,7 @@ from components.db import dict_sql_query, sql_query
 from components.google import google_login, get_google_redirect_url
 from components.decorators import activity_leader_login_required
 from components.validation import valid_integer
+from components.roster import get_leader_rosters
 
 # blueprint init
 activity_leader_routes = Blueprint(
@@ -19,74 +20,8 @@ BASEPATH = "/leader"
 @activity_leader_routes.route("/")
 @activity_leader_login_required
 def index():
-    # fetch activities leader has access to
-    query = dict_sql_query(
-        "SELECT activity_id FROM leaders WHERE email = %s",
-        params=(session.get("leader_email"),),
-    )
-
-    activities = []
-    for obj in query:
-        students = []
-
-        # get questions
-        questions = dict_sql_query(
-            "SELECT * FROM questions WHERE activity_id = %s",
-            params=(obj["activity_id"],),
-        )
-
-        # students that selected this activity
-        for student in dict_sql_query(
-            "SELECT * FROM students WHERE chosen_activity = %s",
-            params=(obj["activity_id"],),
-        ):
-            # build answers
-            answers = []
-            for question in questions:
-                answer = dict_sql_query(
-                    "SELECT * FROM answers WHERE question_id = %s AND student_id = %s",
-                    fetchone=True,
-                    params=(question["id"], student["id"]),
-                )
-
-                if not answer:
-                    answers.append()
-                else:
-                    if not question["written_answer"]:
-                        answers.append(
-                            dict_sql_query(
-                                "SELECT text FROM options WHERE id = %s",
-                                fetchone=True,
-                                params=(answer["option_id"],),
-                            )["text"]
-                        )
-                    else:
-                        answers.append(answer["written_answer"])
-
-            students.append(
-                {
-                    "student": student,
-                    "class_name": dict_sql_query(
-                        "SELECT class_name FROM school_classes WHERE id = %s",
-                        fetchone=True,
-                        params=(student["class_id"],),
-                    )["class_name"],
-                    "answers": answers,
-                }
-            )
-
-        # add to list
-        activities.append(
-            {
-                "name": dict_sql_query(
-                    "SELECT name FROM activities WHERE id = %s",
-                    fetchone=True,
-                    params=(obj["activity_id"],),
-                )["name"],
-                "students": students,
-                "questions": questions,
-            }
-        )
+    # students, classes and answers of all activities leader has access to
+    activities = get_leader_rosters(session.get("leader_email"))
 
     return render_template("leader/index.html", activities=activities)
 
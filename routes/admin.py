@@ -2,21 +2,46 @@
 # https://github.com/tullinge/booking
 
 # imports
-from flask import Blueprint, render_template, request, redirect, session, abort
+from flask import (
+    Blueprint,
+    Response,
+    render_template,
+    request,
+    redirect,
+    session,
+    abort,
+)
 from werkzeug.utils import secure_filename
+from urllib.parse import urlencode
+import codecs
 import csv
 
 # components import
-from components.validation import valid_integer, valid_string, valid_email
-from components.db import sql_query, dict_sql_query
+from components.validation import valid_integer, valid_string
+from components.db import sql_query, dict_sql_query, transaction
 from components.decorators import admin_required
-from components.codes import generate_code
+from components.codes import insert_school_classes
 from components.limiter_obj import limiter
-from components.admin import (
-    get_activites_with_spaces,
-    get_activity_questions_and_options,
-)
+from components.admin import get_activity_questions_and_options
+from components.catalogue import get_activity_catalogue, bump_catalogue_generation
 from components.google import get_google_redirect_url, google_login
+from components.booking import delete_activity, delete_student, promote_waitlist
+from components.settings import set_setting, booking_locked
+from components.lottery import (
+    allocation_mode,
+    run_lottery,
+    LotteryRunning,
+    FIRST_COME,
+    LOTTERY,
+)
+from components.student_import import import_students
+from components.export import EXPORTS, export_rows, csv_stream, xlsx_stream
+from components.roster import (
+    get_activity_roster,
+    get_class_roster,
+    get_students_page,
+    STUDENT_STATUSES,
+)
 from components.core import (
     hash_password,
     verify_password,
@@ -131,10 +156,8 @@ def index():
                 400,
             )
 
-        # set
-        sql_query(
-            f"UPDATE settings SET value='{request.form['booking_locked']}' WHERE identifier='booking_locked'"
-        )
+        # set, reaches all workers through the settings service
+        set_setting("booking_locked", request.form["booking_locked"])
 
         return render_template(
             template,
@@ -144,6 +167,69 @@ def index():
         )
 
 
+# lottery allocation mode
+@admin_routes.route("/lottery", methods=["POST", "GET"])
+@admin_required
+def lottery():
+    """
+    Lottery allocation
+
+    * show allocation mode and amount of students that have ranked activities (GET)
+    * change allocation mode (POST)
+    * run the lottery, or a dry run, while booking is locked (POST)
+    """
+
+    template = "admin/lottery.html"
+
+    def _render(status=200, **kwargs):
+        return (
+            render_template(
+                template,
+                mode=allocation_mode(),
+                amount_students=dict_sql_query(
+                    "SELECT COUNT(DISTINCT student_id) AS amount FROM preferences",
+                    fetchone=True,
+                )["amount"],
+                **kwargs,
+            ),
+            status,
+        )
+
+    if request.method == "GET":
+        return _render()
+
+    data = request.form
+
+    if data.get("request_type") == "mode":
+        if data.get("mode") not in [FIRST_COME, LOTTERY]:
+            return _render(400, fail="Ogiltigt läge.")
+
+        set_setting("allocation_mode", data["mode"])
+
+        return _render(success="Uppdaterat läge.")
+
+    if data.get("request_type") == "run":
+        if not booking_locked():
+            return _render(400, fail="Lås systemet för elever innan lottningen körs.")
+
+        seed = data.get("seed") or None
+        dry_run = bool(data.get("dry_run"))
+
+        try:
+            metrics = run_lottery(seed=seed, dry_run=dry_run)
+        except LotteryRunning:
+            return _render(409, fail="Lottningen körs redan, vänta tills den är klar.")
+
+        return _render(
+            metrics=metrics,
+            seed=seed,
+            dry_run=dry_run,
+            success="Provkörning klar." if dry_run else "Lottningen är klar.",
+        )
+
+    return _render(400, fail="Ogiltig förfrågan.")
+
+
 # activities
 @admin_routes.route("/activities", methods=["POST", "GET"])
 @admin_required
@@ -156,7 +242,7 @@ def activities():
     """
 
     template = "admin/activities.html"
-    activities = get_activites_with_spaces()
+    activities = get_activity_catalogue()
 
     if request.method == "GET":
         return render_template("admin/activities.html", activities=activities)
@@ -206,9 +292,10 @@ def activities():
             sql_query(
                 f"INSERT INTO activities (name, spaces, info) VALUES ('{data['name']}', {data['spaces']}, '{data['info']}')"
             )
+            bump_catalogue_generation()
 
             # re-fetch
-            activities = get_activites_with_spaces()
+            activities = get_activity_catalogue()
 
             # success
             return render_template(
@@ -237,19 +324,12 @@ def activities():
                     400,
                 )
 
-            # delete activity
-            sql_query(f"DELETE FROM activities WHERE id={data['id']}")
-
-            # set chosen_activity to null on students that have booked this one
-            sql_query(
-                f"UPDATE students SET chosen_activity=NULL WHERE chosen_activity={data['id']}"
-            )
-
-            # delete activity leaders
-            sql_query(f"DELETE FROM leaders WHERE activity_id={data['id']}")
+            # delete activity, its bookings and leaders
+            delete_activity(int(data["id"]))
+            bump_catalogue_generation()
 
             # re-fetch
-            activities = get_activites_with_spaces()
+            activities = get_activity_catalogue()
 
             # success
             return (
@@ -349,6 +429,7 @@ def selected_activity(id):
                 sql_query(
                     f"INSERT INTO questions (activity_id, question, written_answer, obligatory) VALUES ({id}, '{data['question']}', 1, {obligatory})"
                 )
+                bump_catalogue_generation()
 
                 # re-fetch
                 questions = get_activity_questions_and_options(id)
@@ -365,6 +446,7 @@ def selected_activity(id):
             sql_query(
                 f"INSERT INTO questions (activity_id, question, written_answer) VALUES ({id}, '{data['question']}', 0)"
             )
+            bump_catalogue_generation()
 
             # re-fetch
             questions = get_activity_questions_and_options(id)
@@ -401,14 +483,12 @@ def selected_activity(id):
                     400,
                 )
 
-            # delete
-            sql_query(f"DELETE FROM questions WHERE id={data['id']}")
-
-            # delete options
-            sql_query(f"DELETE FROM options WHERE question_id={data['id']}")
-
-            # delete students answers
-            sql_query(f"DELETE FROM answers WHERE question_id={data['id']}")
+            # delete, foreign keys delete its options and students answers
+            sql_query(
+                "DELETE FROM questions WHERE id = %s AND activity_id = %s",
+                params=(data["id"], id),
+            )
+            bump_catalogue_generation()
 
             # re-fetch
             questions = get_activity_questions_and_options(id)
@@ -504,6 +584,10 @@ def edit_activity(id):
         sql_query(
             f"UPDATE activities SET name = '{request.form['name']}', spaces = {request.form['spaces']}, info = '{request.form['info']}' WHERE id={id}"
         )
+        bump_catalogue_generation()
+
+        # added spaces go to students waiting for this activity
+        promote_waitlist(int(id))
 
         # re-fetch
         activity = sql_query(f"SELECT * FROM activities WHERE id={id}")
@@ -591,6 +675,7 @@ def question_id(id):
         sql_query(
             f"INSERT INTO options (question_id, text) VALUES ({id}, '{data['text']}')"
         )
+        bump_catalogue_generation()
 
         # re-fetch
         options = sql_query(f"SELECT * FROM options WHERE question_id={question[0][0]}")
@@ -623,9 +708,10 @@ def activity_students(id):
             400,
         )
 
-    activity = sql_query(f"SELECT * FROM activities WHERE id={id}")
+    # students that have booked this activity, their classes and answers
+    roster = get_activity_roster(id)
 
-    if not activity:
+    if not roster:
         return (
             render_template(
                 "errors/custom.html", title="400", message="Activity dose not exist."
@@ -633,43 +719,63 @@ def activity_students(id):
             400,
         )
 
-    # get students that have booked this activity and their answers
-    query = sql_query(
-        f"SELECT id, last_name, first_name, class_id, attendance FROM students WHERE chosen_activity={id}"
+    return render_template(
+        "admin/activity_students.html",
+        students=roster["students"],
+        activity=roster["activity"],
+        questions=roster["questions"],
     )
 
-    students = []
-    for student in query:
-        answer_query = sql_query(
-            f"SELECT option_id, written_answer FROM answers WHERE student_id={student[0]}"
-        )
 
-        answers = []
-        for answer in answer_query:
-            if answer[0] is not None:
-                option_name = sql_query(
-                    f"SELECT text FROM options WHERE id={answer[0]}"
-                )[0][0]
-                answers.append(option_name)
-            else:
-                answers.append(answer[1])
+# export students, bookings and answers
+@admin_routes.route("/export/<export>")
+@admin_routes.route("/export/<export>/<id>")
+@admin_required
+def export_students(export, id=None):
+    """
+    Export of students along with their bookings and answers
 
-        try:
-            class_name = sql_query(
-                f"SELECT class_name FROM school_classes WHERE id={student[3]}"
-            )[0][0]
-        except Exception:
-            class_name = "error"
+    * bookings, unbooked, activity/<id> or class/<id>
+    * ?format=csv (default) or ?format=xlsx
+    * streamed, any amount of students can be exported (GET)
+    """
 
-        students.append((student, answers, class_name))
+    file_format = request.args.get("format", "csv")
 
-    questions = sql_query(f"SELECT question FROM questions WHERE activity_id={id}")
+    if export not in EXPORTS or file_format not in ["csv", "xlsx"]:
+        return (
+            render_template(
+                "errors/custom.html", title="400", message="Invalid export."
+            ),
+            400,
+        )
 
-    return render_template(
-        "admin/activity_students.html",
-        students=students,
-        activity=activity[0],
-        questions=questions,
+    needs_id = export in ["activity", "class"]
+
+    if needs_id != (id is not None) or (needs_id and not valid_integer(id)):
+        return (
+            render_template(
+                "errors/custom.html", title="400", message="Id must be integer."
+            ),
+            400,
+        )
+
+    header, rows = export_rows(export, int(id) if needs_id else None)
+    filename = f"{export}-{id}" if needs_id else export
+
+    if file_format == "xlsx":
+        stream = xlsx_stream(header, rows)
+        mimetype = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    else:
+        stream = csv_stream(header, rows)
+        mimetype = "text/csv"
+
+    return Response(
+        stream,
+        mimetype=mimetype,
+        headers={
+            "Content-Disposition": f'attachment; filename="{filename}.{file_format}"'
+        },
     )
 
 
@@ -845,33 +951,49 @@ def students():
     * list all students/codes (GET)
     """
 
+    search = request.args.get("q", "").strip()[:100]
+    status = request.args.get("status")
+    after = request.args.get("after")
+    before = request.args.get("before")
+
+    if status not in STUDENT_STATUSES:
+        status = None
+
+    def _page_url(**cursor):
+        # links to neighbouring pages keep the current filters
+        filters = {"q": search, "status": status, **cursor}
+        return "/admin/students?" + urlencode(
+            {key: value for key, value in filters.items() if value}
+        )
+
     def _get_students():
-        students = []
-        if request.args.get("show"):
-            for student in dict_sql_query("SELECT * FROM students"):
-                students.append(
-                    {
-                        "student": student,
-                        "activity_name": dict_sql_query(
-                            f"SELECT name FROM activities WHERE id={student['chosen_activity']}",
-                            fetchone=True,
-                        )["name"]
-                        if student["chosen_activity"]
-                        else "Ej valt",
-                        "class_name": dict_sql_query(
-                            f"SELECT class_name FROM school_classes WHERE id={student['class_id']}",
-                            fetchone=True,
-                        )["class_name"]
-                        if student["class_id"]
-                        else "Har ej gått med.",
-                    }
-                )
-            return students
+        students, has_previous, has_next = get_students_page(
+            search=search,
+            status=status,
+            after=int(after) if valid_integer(after) else None,
+            before=int(before) if valid_integer(before) else None,
+        )
+
+        return {
+            "students": students,
+            "search": search,
+            "status": status,
+            "previous_url": (
+                _page_url(before=students[0]["student"]["id"])
+                if students and has_previous
+                else None
+            ),
+            "next_url": (
+                _page_url(after=students[-1]["student"]["id"])
+                if students and has_next
+                else None
+            ),
+        }
 
-    students = _get_students()
+    page = _get_students()
 
     if request.method == "GET":
-        return render_template("admin/students.html", students=students)
+        return render_template("admin/students.html", **page)
 
     if request.method == "POST":
         data = request.form
@@ -882,7 +1004,7 @@ def students():
                 return (
                     render_template(
                         "/admin/students.html",
-                        students=students,
+                        **page,
                         fail="Saknar variabler.",
                     ),
                     400,
@@ -892,20 +1014,20 @@ def students():
                 return (
                     render_template(
                         "/admin/students.html",
-                        students=students,
+                        **page,
                         fail="Id måste vara heltal.",
                     ),
                     400,
                 )
 
-            # delete
-            sql_query(f"DELETE FROM students WHERE id={data['id']}")
+            # delete, releases the student's seat
+            delete_student(int(data["id"]))
 
             # re-fetch
-            students = _get_students()
+            page = _get_students()
 
             return render_template(
-                "/admin/students.html", students=students, success="Elev raderad."
+                "/admin/students.html", **page, success="Elev raderad."
             )
 
         # delete_from_class
@@ -914,7 +1036,7 @@ def students():
                 return (
                     render_template(
                         "/admin/students.html",
-                        students=students,
+                        **page,
                         fail="Saknar variabler.",
                     ),
                     400,
@@ -924,29 +1046,30 @@ def students():
                 return (
                     render_template(
                         "/admin/students.html",
-                        students=students,
+                        **page,
                         fail="Id måste vara heltal.",
                     ),
                     400,
                 )
 
             # delete
-            sql_query(f"UPDATE students SET class_id=NULL WHERE id={data['id']}")
+            sql_query(
+                "UPDATE students SET class_id = NULL WHERE id = %s",
+                params=(data["id"],),
+            )
 
             # re-fetch
-            students = _get_students()
+            page = _get_students()
 
             return render_template(
                 "/admin/students.html",
-                students=students,
+                **page,
                 success="Elev raderad från klass.",
             )
 
         # if invalid request_type
         return (
-            render_template(
-                "/admin/students.html", students=students, fail="Ogiltig förfrågan."
-            ),
+            render_template("/admin/students.html", **page, fail="Ogiltig förfrågan."),
             400,
         )
 
@@ -1038,9 +1161,8 @@ def school_classes():
                 )
 
             # create
-            sql_query(
-                f"INSERT INTO school_classes (class_name, password) VALUES ('{data['class_name'].upper()}', '{generate_code()}')"
-            )
+            with transaction() as cursor:
+                insert_school_classes(cursor, [data["class_name"].upper()])
 
             # re-fetch
             school_classes = dict_sql_query("SELECT * FROM school_classes")
@@ -1074,11 +1196,8 @@ def school_classes():
                     400,
                 )
 
-            # delete
-            sql_query(f"DELETE FROM school_classes WHERE id={data['id']}")
-
-            # update students
-            sql_query(f"UPDATE students SET class_id=NULL WHERE class_id={data['id']}")
+            # delete, students of the class are left without class (foreign key)
+            sql_query("DELETE FROM school_classes WHERE id = %s", params=(data["id"],))
 
             # re-fetch
             school_classes = dict_sql_query("SELECT * FROM school_classes")
@@ -1126,102 +1245,20 @@ def admin_import_students():
         )
 
     try:
-        csv_raw = file.read().decode("utf-8").splitlines()
-        reader = csv.reader(csv_raw)
-        parsed_csv = list(reader)
-    except Exception:
+        # stream the upload, rows are parsed and written in chunks
+        result = import_students(codecs.iterdecode(file.stream, "utf-8"))
+    except (UnicodeDecodeError, csv.Error):
         return (
             render_template(template, fail="Felaktig CSV fil, kunde ej parsa."),
             400,
         )
-
-    students = []
-    header = parsed_csv[0]
-    counter_students = 0
-    counter_classes = 0
-
-    # first row will be HEADERS in new students list
-
-    for row in parsed_csv[1:]:
-        if len(row) != len(header):
-            return (
-                render_template(
-                    template,
-                    fail=f"Rad har fel antal kolumner.",
-                ),
-                400,
-            )
-
-        students.append({header[i]: row[i] for i in range(len(header))})
-
-    for student in students:
-        # get class name
-        class_name = student["titleTextBox"].split(" ")[1].upper()
-        email = student["htmlTextBox9"]
-        fullname = student["htmlTextBox1"]
-        firstname = fullname.split(" ")[0]
-        lastname = fullname.split(" ")[1]
-
-        # check that class name is valid
-        if not valid_string(
-            class_name,
-            min_length=3,
-            max_length=10,
-            allow_space=False,
-            allow_newline=False,
-            allow_punctuation=False,
-        ):
-            return (
-                render_template(
-                    template,
-                    fail="Innehåller ogiltiga tecken i klassnamn på någon elev.",
-                ),
-                400,
-            )
-
-        # check that email is valid
-        if not valid_email(email):
-            return (
-                render_template(
-                    template,
-                    fail="Innehåller ogiltiga tecken i e-post på någon elev.",
-                ),
-                400,
-            )
-
-        # check that class does not exist, if it does, create it
-        class_id = dict_sql_query(
-            f"SELECT id FROM school_classes WHERE class_name='{class_name}'",
-            fetchone=True,
-        )
-        if not class_id:
-            sql_query(
-                f"INSERT INTO school_classes (class_name, password) VALUES ('{class_name}', '{generate_code()}')"
-            )
-            counter_classes += 1
-        class_id = dict_sql_query(
-            f"SELECT id FROM school_classes WHERE class_name='{class_name}'",
-            fetchone=True,
-        )
-
-        # create student if it does not exist
-        student_id = dict_sql_query(
-            f"SELECT id, class_id FROM students WHERE email='{email}'", fetchone=True
-        )
-        if student_id and student_id["class_id"] == None:
-            sql_query(
-                f"UPDATE students SET class_id={class_id['id']} WHERE email='{email}'"
-            )
-            counter_students += 1
-        if not student_id:
-            sql_query(
-                f"INSERT INTO students (first_name, last_name, email, class_id) VALUES ('{firstname}', '{lastname}', '{email}', {class_id['id']})"
-            )
-            counter_students += 1
+    except ValueError as e:
+        return render_template(template, fail=str(e)), 400
 
     return render_template(
         template,
-        success=f"Skapade {counter_classes} klasser och {counter_students} elever.",
+        success=f"Skapade {result['classes']} klasser och {result['students']} elever.",
+        errors=result["errors"],
     )
 
 
@@ -1246,7 +1283,7 @@ def student_classes(id):
         )
 
     school_class = dict_sql_query(
-        f"SELECT * FROM school_classes WHERE id={id}", fetchone=True
+        "SELECT * FROM school_classes WHERE id = %s", fetchone=True, params=(id,)
     )
 
     if not school_class:
@@ -1257,23 +1294,8 @@ def student_classes(id):
             400,
         )
 
-    # show students with  class defined as this one
-    students = []
-
-    for student in dict_sql_query(
-        f"SELECT * FROM students WHERE class_id={school_class['id']}"
-    ):
-        students.append(
-            {
-                "student": student,
-                "activity_name": dict_sql_query(
-                    f"SELECT name FROM activities WHERE id={student['chosen_activity']}",
-                    fetchone=True,
-                )["name"]
-                if student["chosen_activity"]
-                else "Ej valt",
-            }
-        )
+    # show students with class defined as this one
+    students = get_class_roster(school_class["id"])
 
     return render_template(template, school_class=school_class, students=students)
 
@@ -2,7 +2,16 @@
 # https://github.com/tullinge/booking
 
 # imports
-from flask import Blueprint, render_template, redirect, request, session, jsonify, abort
+from flask import (
+    Blueprint,
+    render_template,
+    redirect,
+    request,
+    session,
+    jsonify,
+    abort,
+    Response,
+)
 
 # components import
 from components.decorators import (
@@ -10,21 +19,43 @@ from components.decorators import (
     user_setup_completed,
     user_not_setup,
     booking_blocked,
+    admission_required,
 )
 from components.core import basic_validation, calculate_available_spaces
 from components.google import google_login, get_google_redirect_url
 from components.validation import valid_integer, valid_string
-from components.student import student_chosen_activity
+from components.student import student_chosen_activity, forget_student
+from components.booking import (
+    book_activity,
+    join_waitlist,
+    leave_waitlist,
+    waitlist_position,
+    FULL,
+    NOT_FOUND,
+)
+from components.catalogue import get_catalogue_activity, get_catalogue
+from components.lottery import (
+    allocation_mode,
+    get_preferences,
+    get_unanswered_preferences,
+    set_preferences,
+    set_preference_answers,
+    LOTTERY,
+    LOTTERY_PREFERENCES,
+)
 from components.db import sql_query, dict_sql_query
+from components.admission import leave_admission
+from components.live_spaces import spaces_stream, LIVE_SPACES
+from components.fragments import render_student_index, minify_html
 from components.limiter_obj import limiter
 
-
 # blueprint init
 student_routes = Blueprint("student_routes", __name__, template_folder="../templates")
 
 
 # index
 @student_routes.route("/")
+@admission_required
 @booking_blocked
 @login_required
 @user_setup_completed
@@ -38,27 +69,146 @@ def index():
 
     chosen_activity = student_chosen_activity()
 
-    activities = []
-    for activity in dict_sql_query("SELECT * FROM activities"):
-        activities.append(
-            {
-                "activity": activity,
-                "available_spaces": calculate_available_spaces(activity["id"]),
-            }
+    # the index is not minified by flask_minify, see render_student_index
+    if allocation_mode() == LOTTERY:
+        return minify_html(
+            render_template(
+                "student/preferences.html",
+                fullname=session.get("fullname"),
+                school_class=session.get("school_class"),
+                activities=list(get_catalogue().values()),
+                preferences=get_preferences(session["id"]),
+                unanswered=get_unanswered_preferences(session["id"]),
+                choices=LOTTERY_PREFERENCES,
+                chosen_activity=chosen_activity,
+            )
         )
 
-    return render_template(
-        "student/index.html",
+    # place in the waitlist of a full activity, if any
+    waitlist = waitlist_position(session["id"])
+    if waitlist:
+        waitlist = {
+            "activity": get_catalogue_activity(waitlist[0]),
+            "position": waitlist[1],
+        }
+
+    # activity list rendered once per catalogue, spaces filled in per request
+    return render_student_index(
         fullname=session.get("fullname"),
         school_class=session.get("school_class"),
-        activities=activities,
         chosen_activity=chosen_activity,
+        waitlist=waitlist,
+        live_spaces=LIVE_SPACES,
     )
 
 
+# live available spaces
+@student_routes.route("/spaces/stream")
+@login_required
+def spaces_stream_route():
+    """
+    Available spaces
+
+    * stream available spaces of activities as they change (GET, Server-Sent Events)
+    """
+
+    if not LIVE_SPACES:
+        abort(404)
+
+    return Response(
+        spaces_stream(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-store", "X-Accel-Buffering": "no"},
+    )
+
+
+# leave waitlist
+@student_routes.route("/waitlist/leave", methods=["POST"])
+@limiter.limit("500 per hour")
+@admission_required
+@booking_blocked
+@login_required
+@user_setup_completed
+def waitlist_leave():
+    """
+    Waitlist
+
+    * leave the waitlist the student is in (POST)
+    """
+
+    leave_waitlist(session["id"])
+
+    return redirect("/")
+
+
+# ranked preferences (lottery allocation mode)
+@student_routes.route("/preferences", methods=["POST"])
+@limiter.limit("500 per hour")
+@admission_required
+@booking_blocked
+@login_required
+@user_setup_completed
+def preferences():
+    """
+    Preferences
+
+    * rank activities, most wanted first (POST)
+    """
+
+    template = "student/preferences.html"
+    catalogue = get_catalogue()
+
+    def _render(status=200, **kwargs):
+        return (
+            render_template(
+                template,
+                fullname=session.get("fullname"),
+                school_class=session.get("school_class"),
+                activities=list(catalogue.values()),
+                choices=LOTTERY_PREFERENCES,
+                chosen_activity=student_chosen_activity(),
+                unanswered=get_unanswered_preferences(session["id"]),
+                **kwargs,
+            ),
+            status,
+        )
+
+    if allocation_mode() != LOTTERY:
+        return redirect("/")
+
+    activity_ids = []
+
+    for priority in range(1, LOTTERY_PREFERENCES + 1):
+        value = request.form.get(str(priority))
+
+        # lower priorities may be left empty
+        if not value:
+            continue
+
+        if not valid_integer(value) or int(value) not in catalogue:
+            return _render(400, preferences=activity_ids, fail="Ogiltig aktivitet.")
+
+        if int(value) in activity_ids:
+            return _render(
+                400,
+                preferences=activity_ids,
+                fail="Samma aktivitet kan bara väljas en gång.",
+            )
+
+        activity_ids.append(int(value))
+
+    if not activity_ids:
+        return _render(400, preferences=[], fail="Välj minst en aktivitet.")
+
+    set_preferences(session["id"], activity_ids)
+
+    return _render(preferences=activity_ids, success="Dina val har sparats.")
+
+
 # login
 @student_routes.route("/login")
 @limiter.limit("800 per hour")
+@admission_required
 def students_login():
     google_signin_url = get_google_redirect_url("/callback")
 
@@ -115,6 +265,7 @@ def students_callback():
     session["picture_url"] = oauth_user["picture"]
     session["id"] = existing_student["id"]
     session["school_class"] = school_class
+    forget_student()
 
     return redirect("/")
 
@@ -139,6 +290,8 @@ def logout():
     session.pop("logged_in", False)
     session.pop("id", None)
     session.pop("school_class", None)
+    forget_student()
+    leave_admission()
 
     return redirect("/login")
 
@@ -146,6 +299,7 @@ def logout():
 # setup
 @student_routes.route("/setup", methods=["POST", "GET"])
 @limiter.limit("500 per hour")
+@admission_required
 @booking_blocked
 @login_required
 @user_not_setup
@@ -210,6 +364,7 @@ def setup():
 
         # set school_class
         session["school_class"] = school_class["class_name"]
+        forget_student()
 
         # redirect to index
         return redirect("/")
@@ -218,6 +373,7 @@ def setup():
 # selected activity
 @student_routes.route("/activity/<id>", methods=["POST", "GET"])
 @limiter.limit("500 per hour")
+@admission_required
 @booking_blocked
 @login_required
 @user_setup_completed
@@ -237,9 +393,8 @@ def selected_activity(id):
             400,
         )
 
-    activity = dict_sql_query(
-        "SELECT * FROM activities WHERE id = %s", fetchone=True, params=(id,)
-    )
+    # activity with questions and options, from the catalogue cache
+    activity = get_catalogue_activity(id)
 
     if not activity:
         return (
@@ -249,24 +404,8 @@ def selected_activity(id):
             400,
         )
 
-    # check if activity has questions
-    query = dict_sql_query(
-        "SELECT * FROM questions WHERE activity_id = %s", params=(id,)
-    )
-    questions = []
-
-    if query:
-        # loops query to add each options for questions into list
-        for question in query:
-            questions.append(
-                {
-                    "info": question,
-                    "options": dict_sql_query(
-                        "SELECT * FROM options WHERE question_id = %s",
-                        params=(question["id"],),
-                    ),
-                }
-            )
+    questions = activity["questions"]
+    lottery = allocation_mode() == LOTTERY
 
     if request.method == "GET":
         return render_template(
@@ -276,10 +415,23 @@ def selected_activity(id):
             school_class=session.get("school_class"),
             questions=questions,
             available_spaces=calculate_available_spaces(id),
+            lottery=lottery,
         )
 
     if request.method == "POST":
-        for k, v in request.form.items():
+        # questions of this activity by id, answers to other questions are rejected
+        activity_questions = {q["info"]["id"]: q["info"] for q in questions}
+        question_options = {
+            q["info"]["id"]: {option["id"] for option in q["options"]}
+            for q in questions
+        }
+        answers = []
+
+        # set by the queue button, the student asked to wait for a seat
+        waitlist = request.form.get("waitlist") == "1"
+        form = {k: v for k, v in request.form.items() if k != "waitlist"}
+
+        for k, v in form.items():
             if not valid_integer(k):
                 return (
                     render_template(
@@ -294,9 +446,7 @@ def selected_activity(id):
                     400,
                 )
 
-            question = dict_sql_query(
-                "SELECT * FROM questions WHERE id = %s", fetchone=True, params=(k,)
-            )
+            question = activity_questions.get(int(k))
 
             if not question:
                 return (
@@ -350,11 +500,31 @@ def selected_activity(id):
                     400,
                 )
 
-        if len(request.form) < len(
-            dict_sql_query(
-                "SELECT * FROM questions WHERE activity_id = %s", params=(id,)
-            )
-        ):
+            # option must belong to the question, else the answer insert fails
+            if (
+                v
+                and not question["written_answer"]
+                and (
+                    not valid_integer(v)
+                    or int(v) not in question_options[question["id"]]
+                )
+            ):
+                return (
+                    render_template(
+                        "student/activity.html",
+                        activity=activity,
+                        fullname=session.get("fullname"),
+                        school_class=session.get("school_class"),
+                        questions=questions,
+                        available_spaces=calculate_available_spaces(id),
+                        fail="Svarsalternativ existerar inte.",
+                    ),
+                    400,
+                )
+
+            answers.append((question, v))
+
+        if len(form) < len(questions):
             return (
                 render_template(
                     "student/activity.html",
@@ -368,8 +538,51 @@ def selected_activity(id):
                 400,
             )
 
-        # check if it still has available_spaces
-        if calculate_available_spaces(id) < 1:
+        # activities are assigned by the lottery, answers are stored with the ranking
+        if lottery:
+            if int(id) not in get_preferences(session["id"]):
+                return (
+                    render_template(
+                        "student/activity.html",
+                        activity=activity,
+                        fullname=session.get("fullname"),
+                        school_class=session.get("school_class"),
+                        questions=questions,
+                        available_spaces=calculate_available_spaces(id),
+                        lottery=lottery,
+                        fail="Rangordna aktiviteten på startsidan innan du svarar på frågorna.",
+                    ),
+                    400,
+                )
+
+            set_preference_answers(session["id"], int(id), answers)
+
+            return render_template(
+                "student/activity.html",
+                activity=activity,
+                fullname=session.get("fullname"),
+                school_class=session.get("school_class"),
+                questions=questions,
+                available_spaces=calculate_available_spaces(id),
+                lottery=lottery,
+                success="Dina svar har sparats och gäller om du lottas till aktiviteten.",
+            )
+
+        # reserve seat and store answers in one transaction
+        result = book_activity(session.get("id"), int(id), answers)
+
+        if result == NOT_FOUND:
+            return (
+                render_template(
+                    "errors/custom.html",
+                    title="400",
+                    message="Activity dose not exist.",
+                ),
+                400,
+            )
+
+        if result == FULL and not waitlist:
+            # the student has to choose to wait, the queue button is now shown
             return (
                 render_template(
                     "student/activity.html",
@@ -377,42 +590,29 @@ def selected_activity(id):
                     fullname=session.get("fullname"),
                     school_class=session.get("school_class"),
                     questions=questions,
-                    available_spaces=calculate_available_spaces(id),
+                    available_spaces=0,
                     fail="Denna aktivitet har inga lediga platser.",
                 ),
                 400,
             )
 
-        # delete any previous answers this user has submitted
-        sql_query(
-            "DELETE FROM answers WHERE student_id = %s", params=(session.get("id"),)
-        )
+        if result == FULL:
+            # wait for a seat instead, the student is booked when one is released
+            position = join_waitlist(session.get("id"), int(id), answers)
 
-        # validation completed
-        for question_id, answer in request.form.items():
-            # check if question is of type written or not
-            question = sql_query(
-                "SELECT * FROM questions WHERE id = %s", params=(question_id,)
-            )[0]
-
-            if question[3]:
-                # written answers
-                sql_query(
-                    "INSERT INTO answers (student_id, question_id, written_answer) VALUES (%s, %s, %s)",
-                    params=(session.get("id"), question_id, str(answer)),
-                )
-            else:
-                # option
-                sql_query(
-                    "INSERT INTO answers (student_id, question_id, option_id) VALUES (%s, %s, %s)",
-                    params=(session.get("id"), question_id, answer),
+            if position:
+                return render_template(
+                    "student/activity.html",
+                    activity=activity,
+                    fullname=session.get("fullname"),
+                    school_class=session.get("school_class"),
+                    questions=questions,
+                    available_spaces=0,
+                    success=f"Denna aktivitet har inga lediga platser. Du står nu i kö som nummer {position} och bokas automatiskt när en plats blir ledig.",
                 )
 
-        # set chosen_activity
-        sql_query(
-            "UPDATE students SET chosen_activity = %s, attendance = 0 WHERE id = %s",
-            params=(int(id), session.get("id")),
-        )
+        # chosen_activity changed
+        forget_student()
 
         return redirect("/confirmation")
 
@@ -420,6 +620,7 @@ def selected_activity(id):
 # confirmation
 @student_routes.route("/confirmation")
 @limiter.limit("500 per hour")
+@admission_required
 @booking_blocked
 @login_required
 @user_setup_completed
@@ -437,20 +638,11 @@ def confirmation():
     )
 
     if chosen_activity:
-        questions = []
-        for q in dict_sql_query(
-            "SELECT * FROM questions WHERE activity_id = %s",
-            params=(chosen_activity["id"],),
-        ):
-            questions.append(
-                {
-                    "object": q,
-                    "options": dict_sql_query(
-                        "SELECT * FROM options WHERE question_id = %s",
-                        params=(q["id"],),
-                    ),
-                }
-            )
+        catalogue_activity = get_catalogue_activity(chosen_activity["id"])
+        questions = [
+            {"object": question["info"], "options": question["options"]}
+            for question in (catalogue_activity or {"questions": []})["questions"]
+        ]
 
     return (
         render_template(
@@ -0,0 +1,428 @@
+# tullinge/booking
+# https://github.com/tullinge/booking
+
+# Replays the booking opening surge against the Flask app, run against a
+# development database (never production). Seeds classes, activities (with
+# questions) and students, then lets every student log in (through the Google
+# OAuth stub), load the index and book activities in parallel, like when
+# booking opens. Reports latency percentiles, throughput and queries per
+# route, and fails if any activity got overbooked.
+#
+# Requires MySQL (or MariaDB) with the schema set up (scripts/setup_db.py).
+# Redis can be the local server (docker-compose) or, with --redis-stub, an
+# in-process fakeredis (pip install "fakeredis[lua]").
+#
+# All requests are served by this one process through Flask's test client,
+# concurrency comes from threads. The numbers compare runs of the same machine
+# (regressions between versions), they are not a capacity estimate for the
+# gunicorn deployment.
+
+import re
+import sys
+import random
+import argparse
+from os import environ
+from pathlib import Path
+from threading import Lock
+from time import perf_counter
+from urllib.parse import quote
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+# Add parent folder
+sys.path.append(str(Path(__file__).parent.parent.absolute()))
+
+EMAIL_DOMAIN = "booking-benchmark.invalid"
+CLASS_PREFIX = "BENCH"
+ACTIVITY_PREFIX = "benchmark"
+
+# https, session cookies are only sent over secure connections
+BASE_URL = "https://localhost"
+
+QUERIES = re.compile(r'desc="(\d+) queries"')
+
+
+def configure(args):
+    """Sets the environment the app reads on import, call before importing it"""
+
+    environ["GOOGLE_OAUTH_STUB"] = "1"
+    environ["GSUITE_DOMAIN_NAME"] = EMAIL_DOMAIN
+    environ["SQL_SERVER_TIMING"] = "1"
+    environ["SQL_REQUEST_LOG"] = "0"
+    environ["ADMISSION_MAX_ACTIVE"] = "0"
+    environ.setdefault("GOOGLE_CLIENT_ID", "benchmark")
+    environ.setdefault("GOOGLE_CLIENT_SECRET", "benchmark")
+    environ.setdefault("MYSQL_POOL_SIZE", str(args.concurrency + 5))
+
+    if args.redis_stub:
+        import fakeredis
+        import components.redis_obj
+
+        # replaced before any module that uses Redis is imported
+        components.redis_obj.redis_client = fakeredis.FakeRedis()
+        environ["RATELIMIT_STORAGE_URI"] = "memory://"
+
+
+class Stats:
+    """Latencies, statuses and query counts of requests by route"""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.latencies = {}
+        self.queries = {}
+        self.statuses = {}
+
+    def record(self, route, seconds, response):
+        queries = QUERIES.search(response.headers.get("Server-Timing", ""))
+
+        with self.lock:
+            self.latencies.setdefault(route, []).append(seconds)
+            self.statuses.setdefault(route, Counter())[response.status_code] += 1
+
+            if queries:
+                self.queries.setdefault(route, []).append(int(queries.group(1)))
+
+
+def percentile(values, share):
+    """Returns the nearest-rank percentile of sorted values"""
+
+    return values[min(len(values) - 1, max(0, round(share * len(values)) - 1))]
+
+
+def seed(args):
+    """Creates classes, activities with questions and students, returns their ids"""
+
+    from components.db import dict_sql_query, transaction
+    from components.codes import insert_school_classes
+    from components.catalogue import bump_catalogue_generation
+
+    with transaction() as cursor:
+        insert_school_classes(
+            cursor, [f"{CLASS_PREFIX}{i:03}" for i in range(args.classes)]
+        )
+
+        cursor.executemany(
+            "INSERT INTO activities (name, spaces, info) VALUES (%s, %s, %s)",
+            [
+                (f"{ACTIVITY_PREFIX} {i}", args.spaces, "created by benchmark_booking")
+                for i in range(args.activities)
+            ],
+        )
+
+    class_ids = [
+        row["id"]
+        for row in dict_sql_query(
+            "SELECT id FROM school_classes WHERE class_name LIKE %s",
+            params=(f"{CLASS_PREFIX}%",),
+        )
+    ]
+    activity_ids = [
+        row["id"]
+        for row in dict_sql_query(
+            "SELECT id FROM activities WHERE name LIKE %s ORDER BY id",
+            params=(f"{ACTIVITY_PREFIX} %",),
+        )
+    ]
+
+    with transaction() as cursor:
+        # one question with options on every activity, a written one on every other
+        cursor.executemany(
+            "INSERT INTO questions (activity_id, question, written_answer, obligatory) VALUES (%s, %s, %s, %s)",
+            [(activity_id, "Storlek", 0, 1) for activity_id in activity_ids]
+            + [(activity_id, "Allergier", 1, 0) for activity_id in activity_ids[::2]],
+        )
+        cursor.execute(
+            f"""
+            INSERT INTO options (question_id, text)
+            SELECT questions.id, sizes.text
+            FROM questions
+            CROSS JOIN (SELECT 'S' AS text UNION ALL SELECT 'M' UNION ALL SELECT 'L') AS sizes
+            WHERE questions.written_answer = 0
+                AND questions.activity_id IN ({", ".join(["%s"] * len(activity_ids))})
+            """,
+            activity_ids,
+        )
+        cursor.executemany(
+            "INSERT INTO students (email, first_name, last_name, class_id) VALUES (%s, %s, %s, %s)",
+            [
+                (
+                    f"elev.{i}@{EMAIL_DOMAIN}",
+                    "Elev",
+                    str(i),
+                    class_ids[i % len(class_ids)],
+                )
+                for i in range(args.students)
+            ],
+        )
+
+    bump_catalogue_generation()
+
+    return activity_ids
+
+
+def cleanup():
+    """Removes everything seed created, foreign keys remove the rest"""
+
+    from components.db import sql_query
+    from components.catalogue import bump_catalogue_generation
+
+    sql_query("DELETE FROM students WHERE email LIKE %s", params=(f"%@{EMAIL_DOMAIN}",))
+    sql_query(
+        "DELETE FROM activities WHERE name LIKE %s", params=(f"{ACTIVITY_PREFIX} %",)
+    )
+    sql_query(
+        "DELETE FROM school_classes WHERE class_name LIKE %s",
+        params=(f"{CLASS_PREFIX}%",),
+    )
+
+    bump_catalogue_generation()
+
+
+def answers_for(activity):
+    """Returns form data answering every question of a catalogue activity"""
+
+    return {
+        str(question["info"]["id"]): (
+            "Inga"
+            if question["info"]["written_answer"]
+            else str(question["options"][0]["id"])
+        )
+        for question in activity["questions"]
+    }
+
+
+def student_rush(app, stats, student, wishes, catalogue):
+    """
+    Runs one student through the booking flow
+
+    Logs in, loads the index and tries the wished activities in order until
+    one is booked, queuing for the first wish if all are full. Returns
+    "booked", "waitlisted" or "failed".
+    """
+
+    client = app.test_client()
+
+    # own address per student, the rate limiter counts per client
+    headers = {
+        "X-Forwarded-For": f"10.{student // 65536 % 256}.{student // 256 % 256}.{student % 256}"
+    }
+
+    def send(route, method, path, **kwargs):
+        started = perf_counter()
+        response = client.open(
+            path, method=method, base_url=BASE_URL, headers=headers, **kwargs
+        )
+        stats.record(route, perf_counter() - started, response)
+        return response
+
+    send("GET /login", "GET", "/login")
+    response = send(
+        "GET /callback",
+        "GET",
+        f"/callback?code={quote(f'elev.{student}@{EMAIL_DOMAIN}')}",
+    )
+
+    if response.status_code != 302:
+        return "failed"
+
+    send("GET /", "GET", "/")
+
+    for activity_id in wishes:
+        send("GET /activity/<id>", "GET", f"/activity/{activity_id}")
+        response = send(
+            "POST /activity/<id>",
+            "POST",
+            f"/activity/{activity_id}",
+            data=answers_for(catalogue[activity_id]),
+        )
+
+        if response.status_code == 302:
+            send("GET /confirmation", "GET", "/confirmation")
+            return "booked"
+
+        # full activities answer with the queue button
+        if b'name="waitlist"' not in response.data:
+            return "failed"
+
+    # full everywhere, the student queues for their first wish
+    response = send(
+        "POST /activity/<id>",
+        "POST",
+        f"/activity/{wishes[0]}",
+        data=dict(answers_for(catalogue[wishes[0]]), waitlist="1"),
+    )
+
+    if response.status_code == 302:
+        send("GET /confirmation", "GET", "/confirmation")
+        return "booked"
+
+    return "waitlisted" if response.status_code == 200 else "failed"
+
+
+def check_overbooking(activity_ids):
+    """Returns activities with more students than spaces or a drifted counter"""
+
+    from components.db import dict_sql_query
+
+    return dict_sql_query(
+        f"""
+        SELECT activities.id, activities.spaces, activities.booked,
+            COUNT(students.id) AS students
+        FROM activities
+        LEFT JOIN students ON students.chosen_activity = activities.id
+        WHERE activities.id IN ({", ".join(["%s"] * len(activity_ids))})
+        GROUP BY activities.id, activities.spaces, activities.booked
+        HAVING students > activities.spaces OR students != activities.booked
+        """,
+        params=activity_ids,
+    )
+
+
+def report(stats, results, seconds):
+    total = sum(len(latencies) for latencies in stats.latencies.values())
+
+    print(
+        f"{'route':22} {'requests':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+        f"{'queries':>8}  statuses"
+    )
+
+    for route, latencies in stats.latencies.items():
+        latencies = sorted(latencies)
+        queries = stats.queries.get(route)
+
+        print(
+            f"{route:22} {len(latencies):>8} "
+            f"{percentile(latencies, 0.50) * 1000:>8.1f} "
+            f"{percentile(latencies, 0.95) * 1000:>8.1f} "
+            f"{percentile(latencies, 0.99) * 1000:>8.1f} "
+            f"{sum(queries) / len(queries) if queries else 0:>8.1f}  "
+            f"{dict(sorted(stats.statuses[route].items()))}"
+        )
+
+    print()
+    print(f"requests: {total} in {seconds:.1f}s, {total / seconds:.0f} requests/s")
+    print(
+        f"students: {dict(Counter(results))}, "
+        f"{results.count('booked') / seconds:.0f} bookings/s"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Booking surge benchmark")
+    parser.add_argument("--classes", type=int, default=30)
+    parser.add_argument("--activities", type=int, default=40)
+    parser.add_argument("--students", type=int, default=2000)
+    parser.add_argument(
+        "--spaces",
+        type=int,
+        default=45,
+        help="spaces per activity, fewer spaces than students makes activities run full",
+    )
+    parser.add_argument(
+        "--wishes",
+        type=int,
+        default=3,
+        help="activities each student tries before giving up (waiting in line)",
+    )
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument(
+        "--redis-stub", action="store_true", help="use fakeredis instead of Redis"
+    )
+    parser.add_argument(
+        "--max-p95-ms",
+        type=float,
+        help="fail if the p95 latency of any route exceeds this",
+    )
+    args = parser.parse_args()
+
+    # the app reads its configuration when imported
+    configure(args)
+
+    from main import app
+    from components.settings import get_setting, set_setting
+    from components.catalogue import get_catalogue
+
+    previous_settings = {
+        identifier: get_setting(identifier)
+        for identifier in ["booking_locked", "allocation_mode"]
+    }
+
+    cleanup()
+    activity_ids = seed(args)
+
+    try:
+        set_setting("booking_locked", "0")
+        set_setting("allocation_mode", "first_come")
+
+        catalogue = get_catalogue()
+        rng = random.Random(args.seed)
+
+        # a few activities are far more popular than the rest, like in reality
+        popularity = [1 / rank for rank in range(1, len(activity_ids) + 1)]
+        wishes = [
+            list(
+                dict.fromkeys(
+                    rng.choices(activity_ids, weights=popularity, k=args.wishes * 3)
+                )
+            )[: args.wishes]
+            for _ in range(args.students)
+        ]
+
+        stats = Stats()
+        started = perf_counter()
+
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            results = list(
+                executor.map(
+                    lambda student: student_rush(
+                        app, stats, student, wishes[student], catalogue
+                    ),
+                    range(args.students),
+                )
+            )
+
+        seconds = perf_counter() - started
+        violations = check_overbooking(activity_ids)
+    finally:
+        for identifier, value in previous_settings.items():
+            if value is not None:
+                set_setting(identifier, value)
+
+        cleanup()
+
+    report(stats, results, seconds)
+
+    failed = False
+
+    if violations:
+        print(f"FAIL: overbooked activities or drifted counters: {violations}")
+        failed = True
+    else:
+        print("overbooking: none")
+
+    errors = sum(
+        amount
+        for statuses in stats.statuses.values()
+        for status, amount in statuses.items()
+        if status >= 500
+    )
+    if errors or "failed" in results:
+        print(
+            f"FAIL: {errors} server errors, {results.count('failed')} students failed"
+        )
+        failed = True
+
+    if args.max_p95_ms is not None:
+        for route, latencies in stats.latencies.items():
+            p95 = percentile(sorted(latencies), 0.95) * 1000
+
+            if p95 > args.max_p95_ms:
+                print(f"FAIL: p95 of {route} is {p95:.1f} ms")
+                failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
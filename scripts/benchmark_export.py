@@ -0,0 +1,112 @@
+# tullinge/booking
+# https://github.com/tullinge/booking
+
+# Memory benchmark for the streamed exports. Feeds synthetic query rows (no
+# database needed) through the same pivot and CSV/XLSX writers as the export
+# endpoints and measures peak memory with tracemalloc. Peak memory should stay
+# flat as the amount of students grows. Every amount has to be at least
+# MIN_STUDENTS, below that the XLSX compressor has not reached its full window
+# and the peak still grows with the amount of students.
+
+import sys
+import argparse
+import tracemalloc
+from pathlib import Path
+
+# Add parent folder
+sys.path.append(str(Path(__file__).parent.parent.absolute()))
+
+from components.export import STUDENT_COLUMNS, pivot_students, csv_stream, xlsx_stream
+
+WRITERS = {"csv": csv_stream, "xlsx": xlsx_stream}
+MIN_STUDENTS = 10000
+
+
+def synthetic_rows(students, questions):
+    """Yields rows shaped like EXPORT_QUERY, one per answer"""
+
+    for student_id in range(1, students + 1):
+        for question_id in range(1, questions + 1):
+            yield {
+                "id": student_id,
+                "first_name": "Förnamn",
+                "last_name": f"Efternamn{student_id}",
+                "email": f"student-{student_id}@example.com",
+                "class_name": f"TE{student_id % 30}",
+                "activity_name": f"Aktivitet {student_id % 40}",
+                "attendance": student_id % 3,
+                "question_id": question_id,
+                "written_answer": "Fritt svar " * 5 if question_id % 2 else None,
+                "option_text": None if question_id % 2 else "Alternativ",
+            }
+
+
+def measure(file_format, students, questions):
+    """Returns (peak bytes, output bytes) of exporting students"""
+
+    header = STUDENT_COLUMNS + [f"Fråga {i}" for i in range(1, questions + 1)]
+    rows = pivot_students(
+        synthetic_rows(students, questions), list(range(1, questions + 1))
+    )
+
+    tracemalloc.start()
+    size = 0
+
+    # chunks are dropped right away, like when written to the client
+    for chunk in WRITERS[file_format](header, rows):
+        size += len(chunk)
+
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return peak, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export memory benchmark")
+    parser.add_argument(
+        "--students",
+        type=int,
+        nargs="+",
+        default=[MIN_STUDENTS, 100000],
+        help=f"amounts of students to export, at least {MIN_STUDENTS}",
+    )
+    parser.add_argument("--questions", type=int, default=4)
+    parser.add_argument(
+        "--format", choices=list(WRITERS), nargs="+", default=["csv", "xlsx"]
+    )
+    parser.add_argument(
+        "--max-growth",
+        type=float,
+        default=1.5,
+        help="fail if peak memory of the largest export exceeds the smallest by this factor",
+    )
+    args = parser.parse_args()
+
+    if min(args.students) < MIN_STUDENTS:
+        parser.error(f"--students must be at least {MIN_STUDENTS}")
+
+    args.students.sort()
+    failed = False
+
+    for file_format in args.format:
+        peaks = []
+
+        for students in args.students:
+            peak, size = measure(file_format, students, args.questions)
+            peaks.append(peak)
+
+            print(
+                f"{file_format:5} {students:>8} students: "
+                f"peak {peak / 1024:8.0f} KiB, output {size / 1024 / 1024:8.1f} MiB"
+            )
+
+        if peaks[-1] > peaks[0] * args.max_growth:
+            print(f"{file_format}: peak memory grows with the amount of students")
+            failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+# tullinge/booking
+# https://github.com/tullinge/booking
+
+# Compares gunicorn worker modes over HTTP. Run it against the app started
+# with entrypoint.sh (or gunicorn directly) in the mode to measure, with the
+# Google OAuth stub and a simulated Google latency:
+#
+#   GOOGLE_OAUTH_STUB=1 GOOGLE_STUB_LATENCY_MS=200 OAUTHLIB_INSECURE_TRANSPORT=1 \
+#   GSUITE_DOMAIN_NAME=booking-benchmark.invalid GOOGLE_CLIENT_ID=booking-benchmark \
+#   GUNICORN_WORKER_CLASS=gthread GUNICORN_THREADS=8 PORT=5000 ./entrypoint.sh
+#
+# GOOGLE_CLIENT_ID lets the ID token be verified locally like in production,
+# without it every login also waits on the userinfo endpoint.
+#
+# Students log in (the callback waits on "Google") while the login page is
+# requested alongside, which shows whether slow callbacks hold up other pages.
+# Students created by the logins are removed afterwards, run it against a
+# development database only.
+
+import sys
+import argparse
+from pathlib import Path
+from threading import Lock
+from time import perf_counter
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+# Add parent folder
+sys.path.append(str(Path(__file__).parent.parent.absolute()))
+
+from components.db import sql_query
+from scripts.benchmark_booking import EMAIL_DOMAIN, percentile
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Worker mode benchmark")
+    parser.add_argument("--url", default="http://localhost:5000")
+    parser.add_argument("--students", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=50)
+    args = parser.parse_args()
+
+    latencies = {}
+    statuses = {}
+    lock = Lock()
+
+    def send(route, path, student):
+        # own address per student, the rate limiter counts per client
+        headers = {
+            "X-Forwarded-For": f"10.{student // 65536 % 256}.{student // 256 % 256}.{student % 256}"
+        }
+
+        started = perf_counter()
+        response = requests.get(
+            args.url + path, headers=headers, allow_redirects=False, timeout=60
+        )
+        seconds = perf_counter() - started
+
+        with lock:
+            latencies.setdefault(route, []).append(seconds)
+            statuses.setdefault(route, Counter())[response.status_code] += 1
+
+    def student(i):
+        send("GET /callback", f"/callback?code=worker.{i}@{EMAIL_DOMAIN}", i)
+        send("GET /login", "/login", i)
+
+    started = perf_counter()
+
+    try:
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            list(executor.map(student, range(args.students)))
+    finally:
+        sql_query(
+            "DELETE FROM students WHERE email LIKE %s",
+            params=(f"worker.%@{EMAIL_DOMAIN}",),
+        )
+
+    seconds = perf_counter() - started
+    total = sum(len(values) for values in latencies.values())
+
+    print(
+        f"{'route':16} {'requests':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}  statuses"
+    )
+
+    for route, values in latencies.items():
+        values = sorted(values)
+
+        print(
+            f"{route:16} {len(values):>8} "
+            f"{percentile(values, 0.50) * 1000:>8.1f} "
+            f"{percentile(values, 0.95) * 1000:>8.1f} "
+            f"{percentile(values, 0.99) * 1000:>8.1f}  "
+            f"{dict(sorted(statuses[route].items()))}"
+        )
+
+    print()
+    print(f"requests: {total} in {seconds:.1f}s, {total / seconds:.0f} requests/s")
+
+
+if __name__ == "__main__":
+    main()
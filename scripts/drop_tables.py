@@ -18,12 +18,16 @@ def drop(query, name=None):
 
 
 if __name__ == "__main__":
-    drop("DROP TABLE activities", name="activities")
-    drop("DROP TABLE questions", name="questions")
-    drop("DROP TABLE options", name="options")
+    # referencing tables first, foreign keys would block the drop otherwise
+    drop("DROP TABLE waitlist", name="waitlist")
+    drop("DROP TABLE preferences", name="preferences")
     drop("DROP TABLE answers", name="answers")
-    drop("DROP TABLE admins", name="admins")
+    drop("DROP TABLE options", name="options")
+    drop("DROP TABLE questions", name="questions")
+    drop("DROP TABLE leaders", name="leaders")
     drop("DROP TABLE students", name="students")
+    drop("DROP TABLE activities", name="activities")
     drop("DROP TABLE school_classes", name="school_classes")
-    drop("DROP TABLE leaders", name="leaders")
+    drop("DROP TABLE admins", name="admins")
     drop("DROP TABLE settings", name="settings")
+    drop("DROP TABLE schema_migrations", name="schema_migrations")
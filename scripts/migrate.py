@@ -0,0 +1,21 @@
+# tullinge/booking
+# https://github.com/tullinge/booking
+
+# Upgrades an existing database to the current schema in place. Safe to run at
+# any time, migrations that have already been applied are skipped.
+
+import sys
+from pathlib import Path
+
+# Add parent folder
+sys.path.append(str(Path(__file__).parent.parent.absolute()))
+
+from components.migrations import migrate
+
+if __name__ == "__main__":
+    applied = migrate()
+
+    if applied:
+        print(f"applied {len(applied)} migrations")
+    else:
+        print("database is up to date")
@@ -0,0 +1,32 @@
+# tullinge/booking
+# https://github.com/tullinge/booking
+
+# Rebuilds activities.booked from the bookings in students. Safe to run at any
+# time, also adds the booked column to databases created before it existed.
+
+import sys
+from pathlib import Path
+
+# Add parent folder
+sys.path.append(str(Path(__file__).parent.parent.absolute()))
+
+from components.db import sql_query
+from components.booking import reconcile_booked
+
+
+def add_booked_column():
+    if sql_query(
+        "SELECT column_name FROM information_schema.columns WHERE table_schema = DATABASE() AND table_name = 'activities' AND column_name = 'booked'"
+    ):
+        return
+
+    sql_query(
+        "ALTER TABLE activities ADD COLUMN booked INT NOT NULL DEFAULT 0 AFTER info"
+    )
+    print("added column activities.booked")
+
+
+if __name__ == "__main__":
+    add_booked_column()
+
+    print(f"reconciled booked counter, {reconcile_booked()} activities changed")
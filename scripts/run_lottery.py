@@ -0,0 +1,91 @@
+# tullinge/booking
+# https://github.com/tullinge/booking
+
+# Runs the lottery allocation (see components/lottery.py) from the command
+# line, same as the admin page. With --synthetic it instead times the
+# allocation on generated students and activities, no database needed.
+
+import sys
+import json
+import random
+import argparse
+from pathlib import Path
+from time import perf_counter
+
+# Add parent folder
+sys.path.append(str(Path(__file__).parent.parent.absolute()))
+
+from components.settings import booking_locked
+from components.lottery import (
+    allocate,
+    allocation_metrics,
+    run_lottery,
+    LotteryRunning,
+    LOTTERY_PREFERENCES,
+)
+
+
+def synthetic(students, activities, seed):
+    """Times allocate on students ranking activities, a few being popular"""
+
+    rng = random.Random(seed)
+    capacities = {activity: rng.randint(10, 40) for activity in range(activities)}
+    popular = list(range(max(1, activities // 5)))
+
+    preferences = {
+        student: rng.sample(
+            popular if rng.random() < 0.7 else list(capacities),
+            min(LOTTERY_PREFERENCES, len(popular)),
+        )
+        for student in range(students)
+    }
+    classes = {student: f"K{student % 40}" for student in preferences}
+
+    start = perf_counter()
+    assignment = allocate(preferences, capacities, seed=seed)
+    elapsed = perf_counter() - start
+
+    metrics = allocation_metrics(assignment, classes)
+    metrics["seconds"] = elapsed
+
+    return metrics
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Lottery allocation")
+    parser.add_argument("--seed", help="seed for the random order")
+    parser.add_argument(
+        "--dry-run", action="store_true", help="print the result without booking"
+    )
+    parser.add_argument(
+        "--synthetic",
+        type=int,
+        metavar="STUDENTS",
+        help="time the allocation on this many generated students",
+    )
+    parser.add_argument(
+        "--activities", type=int, default=300, help="activities with --synthetic"
+    )
+    args = parser.parse_args()
+
+    if args.synthetic:
+        print(
+            json.dumps(synthetic(args.synthetic, args.activities, args.seed), indent=2)
+        )
+        return
+
+    if not args.dry_run and not booking_locked():
+        print("lock booking for students before running the lottery")
+        sys.exit(1)
+
+    try:
+        metrics = run_lottery(seed=args.seed, dry_run=args.dry_run)
+    except LotteryRunning:
+        print("another lottery is running")
+        sys.exit(1)
+
+    print(json.dumps(metrics, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -8,6 +8,7 @@ from pathlib import Path
 sys.path.append(str(Path(__file__).parent.parent.absolute()))
 
 from components.db import sql_query
+from components.migrations import migrate
 
 
 def insert(query, name=None):
@@ -27,6 +28,7 @@ def create_tabels():
             name VARCHAR(50) DEFAULT NULL,
             spaces INT DEFAULT NULL,
             info VARCHAR(511) DEFAULT NULL,
+            booked INT NOT NULL DEFAULT 0,
             PRIMARY KEY (id)
         );
     """,
@@ -158,3 +160,6 @@ def create_tabels():
 
 if __name__ == "__main__":
     create_tabels()
+
+    # indexes and foreign keys are added by the migrations
+    migrate()
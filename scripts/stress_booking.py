@@ -0,0 +1,104 @@
+# tullinge/booking
+# https://github.com/tullinge/booking
+
+# Concurrency stress test for the booking engine, run against a development
+# database (never production). Creates a temporary activity and students, fires
+# parallel bookings at the activity and verifies it is not overbooked.
+
+import sys
+import argparse
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+# Add parent folder
+sys.path.append(str(Path(__file__).parent.parent.absolute()))
+
+from components.db import sql_query, dict_sql_query, transaction
+from components.booking import book_activity, BOOKED, FULL
+
+EMAIL_DOMAIN = "stress-test.invalid"
+
+
+def setup(students, spaces):
+    sql_query(
+        "INSERT INTO activities (name, spaces, info) VALUES (%s, %s, %s)",
+        params=("stress test", spaces, "created by scripts/stress_booking.py"),
+    )
+    activity_id = dict_sql_query(
+        "SELECT MAX(id) AS id FROM activities WHERE name = 'stress test'",
+        fetchone=True,
+    )["id"]
+
+    with transaction() as cursor:
+        cursor.executemany(
+            "INSERT INTO students (email, first_name, last_name) VALUES (%s, %s, %s)",
+            [
+                (f"student-{i}@{EMAIL_DOMAIN}", "Stress", str(i))
+                for i in range(students)
+            ],
+        )
+
+    student_ids = [
+        row[0]
+        for row in sql_query(
+            "SELECT id FROM students WHERE email LIKE %s",
+            params=(f"%@{EMAIL_DOMAIN}",),
+        )
+    ]
+
+    return activity_id, student_ids
+
+
+def cleanup(activity_id):
+    sql_query(
+        "DELETE FROM answers WHERE student_id IN (SELECT id FROM students WHERE email LIKE %s)",
+        params=(f"%@{EMAIL_DOMAIN}",),
+    )
+    sql_query("DELETE FROM students WHERE email LIKE %s", params=(f"%@{EMAIL_DOMAIN}",))
+    sql_query("DELETE FROM activities WHERE id = %s", params=(activity_id,))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Booking concurrency stress test")
+    parser.add_argument("--students", type=int, default=2000)
+    parser.add_argument("--spaces", type=int, default=10)
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=50,
+        help="parallel bookings, keep MYSQL_POOL_SIZE close to this value",
+    )
+    args = parser.parse_args()
+
+    activity_id, student_ids = setup(args.students, args.spaces)
+
+    try:
+        with ThreadPoolExecutor(max_workers=args.threads) as executor:
+            results = list(
+                executor.map(
+                    lambda student_id: book_activity(student_id, activity_id, []),
+                    student_ids,
+                )
+            )
+
+        booked = dict_sql_query(
+            "SELECT COUNT(*) AS booked FROM students WHERE chosen_activity = %s",
+            fetchone=True,
+            params=(activity_id,),
+        )["booked"]
+    finally:
+        cleanup(activity_id)
+
+    print(f"bookings attempted: {len(results)}")
+    print(f"booked: {results.count(BOOKED)}, full: {results.count(FULL)}")
+    print(f"students booked in database: {booked} (spaces: {args.spaces})")
+
+    if booked != args.spaces or results.count(BOOKED) != args.spaces:
+        print("FAIL: activity overbooked or seats left unused")
+        sys.exit(1)
+
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()